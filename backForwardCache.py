@@ -0,0 +1,86 @@
+from collections import OrderedDict
+from cssParser import tree_to_list
+
+# estimated size of the pages kept before least recently used ones
+# are dropped
+BFCACHE_SIZE = 64 * 1024 * 1024
+# rough bytes per DOM node, layout object and draw command
+NODE_BYTES = 500
+LAYOUT_BYTES = 400
+COMMAND_BYTES = 300
+
+# tab attributes that make up a loaded page
+PAGE_STATE = [
+    "url", "history_index", "nodes", "rules", "stylesheet", "document",
+    "display_list", "layout_index", "dirty_nodes", "js", "scroll",
+    "allowed_origins",
+]
+
+
+# a page as it was when the tab left it
+class PageState:
+    def __init__(self, tab):
+        self.state = {name: getattr(tab, name) for name in PAGE_STATE}
+        self.url = tab.url
+        self.size = len(tree_to_list(tab.nodes, [])) * NODE_BYTES + \
+            len(tree_to_list(tab.document, [])) * LAYOUT_BYTES + \
+            len(tab.display_list) * COMMAND_BYTES
+
+    def restore(self, tab):
+        for name, value in self.state.items():
+            setattr(tab, name, value)
+        tab.focus = None
+
+
+# recently left pages of one tab, by their index in its history,
+# so going back to them needs no loading at all
+class BackForwardCache:
+    def __init__(self, max_size=BFCACHE_SIZE):
+        self.max_size = max_size
+        # {history index: PageState}, least recently used first
+        self.pages = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def store(self, index, tab):
+        self.remove(index)
+        page = PageState(tab)
+        if page.size > self.max_size:
+            return
+        self.pages[index] = page
+        self.size += page.size
+        while self.size > self.max_size:
+            oldest = next(iter(self.pages))
+            self.remove(oldest)
+
+    # the page at index if it is still kept (and is of url); it is
+    # taken out since the tab is about to show it
+    def take(self, index, url):
+        page = self.pages.get(index)
+        if page is None or page.url != url:
+            self.misses += 1
+            return None
+        self.remove(index)
+        self.hits += 1
+        return page
+
+    def remove(self, index):
+        page = self.pages.pop(index, None)
+        if page:
+            self.size -= page.size
+
+    # forget pages at index and after, which can't be gone back to
+    def discard_from(self, index):
+        for stale in [i for i in self.pages if i >= index]:
+            self.remove(stale)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "pages": len(self.pages),
+            "size": self.size,
+        }
@@ -0,0 +1,517 @@
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# micro-benchmarks for the rendering pipeline
+# run with: python3 benchmark.py [name ...]
+
+# keep the benchmarks away from the user's HTTP cache (see httpCache.py)
+os.environ.setdefault("BROWSER_HTTP_CACHE",
+                      os.path.join(tempfile.gettempdir(), "browser-benchmark"))
+
+
+def timed(f, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+# a long article: paragraphs with inline markup, lists and links
+def make_document(paragraphs):
+    parts = ["<!doctype html><html><head><title>Benchmark</title>"
+             "<link rel=stylesheet href=/style.css></head><body>"]
+    for i in range(paragraphs):
+        parts.append(
+            "<h2>Section {}</h2><p class=\"text\">Lorem ipsum <b>dolor</b> "
+            "sit amet, <a href=\"/page{}\">consectetur</a> adipiscing elit, "
+            "sed do <i>eiusmod</i> tempor incididunt ut labore et dolore "
+            "magna aliqua.</p><ul><li>one</li><li>two</li></ul>\n"
+            .format(i, i))
+    parts.append("</body></html>")
+    return "".join(parts)
+
+
+def bench_parser():
+    import tabs
+    from htmlParser import HTMLParser
+    print("HTMLParser.parse, and Tab.parse fed like a page load")
+    for paragraphs in [1000, 2000, 4000, 8000, 16000]:
+        body = make_document(paragraphs)
+        chunks = [body[i:i + tabs.FIRST_PAINT_CHARS]
+                  for i in range(0, len(body), tabs.FIRST_PAINT_CHARS)]
+        whole = timed(lambda: HTMLParser(body).parse())
+        fed = timed(lambda: tabs.Tab().parse(chunks))
+        mb = len(body) / 1e6
+        print("  {:6.2f} MB  parse {:6.1f} ms/MB  fed {:6.1f} ms/MB".format(
+            mb, whole * 1000 / mb, fed * 1000 / mb))
+
+
+# bytes allocated (and still alive) while running f
+def allocated(f):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = f()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, after - before
+
+
+# the node model before __slots__: one __dict__ per node,
+# a fresh children list per node and uninterned names
+class DictText:
+    def __init__(self, text, parent):
+        self.text = text
+        self.children = []
+        self.parent = parent
+
+
+class DictElement:
+    def __init__(self, tag, attributes, parent, cls=None):
+        self.tag = tag
+        self.attributes = attributes
+        self.children = []
+        self.parent = parent
+        self.cls = cls
+
+
+def to_dict_nodes(node, parent=None):
+    from htmlParser import Text
+    if isinstance(node, Text):
+        return DictText(node.text, parent)
+    # copy names so they are not shared, like the parser used to build them
+    attributes = {"".join(k): v for k, v in node.attributes.items()}
+    copy = DictElement("".join(node.tag), attributes, parent,
+                       node.cls and "".join(node.cls))
+    for child in node.children:
+        copy.children.append(to_dict_nodes(child, copy))
+    return copy
+
+
+def bench_memory():
+    from htmlParser import HTMLParser, NodeStore
+    from cssParser import tree_to_list
+    print("DOM memory")
+    for paragraphs in [2000, 8000]:
+        tree = HTMLParser(make_document(paragraphs)).parse()
+        count = len(tree_to_list(tree, []))
+        # all three share the parsed text, so only node overhead counts
+        store, store_size = allocated(lambda: NodeStore.from_tree(tree))
+        _, compact = allocated(store.to_tree)
+        _, dict_nodes = allocated(lambda: to_dict_nodes(tree))
+        print("  {} nodes".format(count))
+        for name, size in [("__dict__ nodes", dict_nodes),
+                           ("__slots__ nodes", compact),
+                           ("NodeStore", store_size)]:
+            print("    {:16} {:8.1f} MB  {:5.0f} bytes/node".format(
+                name, size / 1e6, size / count))
+
+
+# nested <div>s, each level holding a bit of inline content
+def make_nested_document(depth, width):
+    level = "<p>text <span class=\"note\">note</span> <b>bold</b></p>" * width
+    return "<html><body>" + ("<div>" + level) * depth + \
+        "</div>" * depth + "</body></html>"
+
+
+# descendant rules whose ancestors mostly don't occur in the page
+def make_descendant_rules(count):
+    ancestors = ["article", "section", "nav", "aside", "table", "form"]
+    targets = ["span", "b", "p", ".note"]
+    rules = []
+    for i in range(count):
+        rules.append("{} {} {} {{ color: red; }}".format(
+            ancestors[i % len(ancestors)], "div" if i % 2 else "p",
+            targets[i % len(targets)]))
+    rules.append("div span { color: blue; }")
+    return "\n".join(rules)
+
+
+def bench_descendant():
+    import cssParser
+    from htmlParser import HTMLParser
+    from cssParser import CSSParser, StyleSheet, style
+    print("style() with deep nesting and descendant rules")
+    rules = CSSParser(make_descendant_rules(100)).parse()
+    may_contain = cssParser.AncestorFilter.may_contain
+    for depth in [25, 50, 100]:
+        tree = HTMLParser(make_nested_document(depth, 3)).parse()
+        # a new sheet each run, so its style cache doesn't answer the
+        # nodes before any selector is matched
+        with_filter = timed(lambda: style(tree, StyleSheet(rules)))
+        cssParser.AncestorFilter.may_contain = lambda self, keys: True
+        try:
+            without_filter = timed(lambda: style(tree, StyleSheet(rules)),
+                                   repeat=1)
+        finally:
+            cssParser.AncestorFilter.may_contain = may_contain
+        print("  depth {:4}  filter {:8.1f} ms  parent walk {:8.1f} ms".format(
+            depth, with_filter * 1000, without_filter * 1000))
+
+
+def bench_style_sharing():
+    import cssParser
+    from htmlParser import HTMLParser
+    from cssParser import CSSParser, StyleSheet, style, tree_to_list
+    print("style() with computed-style sharing")
+    with open("browser8.css") as f:
+        rules = CSSParser(f.read()).parse()
+    body = make_document(8000)
+
+    def unshared(node, rules, ancestors):
+        return cssParser.ComputedStyle(
+            cssParser.compute_node_style(node, rules, ancestors))
+
+    def run(name):
+        tree = HTMLParser(body).parse()
+        sheet = StyleSheet(rules)
+        seconds = timed(lambda: style(tree, StyleSheet(rules)))
+        # memory held by the computed styles of a freshly parsed tree
+        tree = HTMLParser(body).parse()
+        _, size = allocated(lambda: style(tree, sheet))
+        print("  {:9} {:8.1f} ms  {:8.3f} MB".format(
+            name, seconds * 1000, size / 1e6))
+        return tree, sheet
+
+    tree, sheet = run("shared")
+    print("  {} nodes, {}".format(
+        len(tree_to_list(tree, [])), sheet.sharing_stats()))
+    shared_style = cssParser.shared_style
+    cssParser.shared_style = unshared
+    try:
+        run("unshared")
+    finally:
+        cssParser.shared_style = shared_style
+
+
+# parsed and styled tree for the layout benchmarks
+def make_styled_tree(paragraphs):
+    from htmlParser import HTMLParser
+    from cssParser import CSSParser, style
+    with open("browser8.css") as f:
+        rules = CSSParser(f.read()).parse()
+    tree = HTMLParser(make_document(paragraphs)).parse()
+    style(tree, rules)
+    return tree
+
+
+def layout_document(tree, limit=None):
+    from layoutEngine import DocumentLayout
+    document = DocumentLayout(tree)
+    with contextlib.redirect_stdout(io.StringIO()):
+        document.layout(limit)
+    return document
+
+
+# fonts need a Tk root unless a headless metrics table is in use
+# (see BROWSER_FONT_METRICS in display.py); returns False if neither
+def setup_fonts():
+    import display
+    if display.is_headless():
+        return None
+    import tkinter
+    try:
+        root = tkinter.Tk()
+    except tkinter.TclError:
+        print("  (needs a display or BROWSER_FONT_METRICS)")
+        return False
+    root.withdraw()
+    return root
+
+
+def bench_layout():
+    import display
+    print("DocumentLayout.layout with the word-width cache")
+    root = setup_fonts()
+    if root is False:
+        return
+    tree = make_styled_tree(2000)
+
+    def cold():
+        display.WORD_WIDTHS.clear()
+        layout_document(tree)
+    measure = display.measure
+    display.measure = lambda font, word: font.font.measure(word)
+    try:
+        uncached = timed(lambda: layout_document(tree))
+    finally:
+        display.measure = measure
+    cold_time = timed(cold)
+    warm_time = timed(lambda: layout_document(tree))
+    print("  Tk measure every word  {:8.1f} ms".format(uncached * 1000))
+    print("  empty cache            {:8.1f} ms".format(cold_time * 1000))
+    print("  warm cache             {:8.1f} ms".format(warm_time * 1000))
+    print("  {}".format(display.measure_stats()))
+    if root:
+        root.destroy()
+
+
+def bench_lazy_layout():
+    from display import HEIGHT, CHROME_PX, LAYOUT_OVERSCAN
+    print("DocumentLayout.layout of the first viewport")
+    root = setup_fonts()
+    if root is False:
+        return
+    limit = HEIGHT - CHROME_PX + LAYOUT_OVERSCAN
+    for paragraphs in [500, 2000, 8000]:
+        tree = make_styled_tree(paragraphs)
+        full = timed(lambda: layout_document(tree))
+        lazy = timed(lambda: layout_document(tree, limit))
+        print("  {:5d} paragraphs  whole page {:8.1f} ms  "
+              "first viewport {:6.2f} ms".format(
+                  paragraphs, full * 1000, lazy * 1000))
+    if root:
+        root.destroy()
+
+
+# stands in for the Tk canvas when timing draws
+class NullCanvas:
+    def create_text(self, *args, **kwargs):
+        pass
+
+    def create_rectangle(self, *args, **kwargs):
+        pass
+
+
+def bench_scroll():
+    from display import HEIGHT, CHROME_PX
+    from displayList import DisplayList
+    print("drawing one frame while scrolling through the page")
+    root = setup_fonts()
+    if root is False:
+        return
+    canvas = NullCanvas()
+    view = HEIGHT - CHROME_PX
+    for paragraphs in [500, 2000, 8000]:
+        document = layout_document(make_styled_tree(paragraphs))
+        display_list = DisplayList()
+        document.paint(display_list)
+        commands = list(display_list)
+        scrolls = range(0, int(document.height) - view, 5000)
+
+        # the old Tab.draw: look at every command
+        def scan():
+            for scroll in scrolls:
+                for cmd in commands:
+                    if cmd.top > scroll + view:
+                        continue
+                    if cmd.bottom < scroll:
+                        continue
+                    cmd.execute(scroll - CHROME_PX, canvas)
+
+        def indexed():
+            for scroll in scrolls:
+                for cmd in display_list.visible(scroll, scroll + view):
+                    cmd.execute(scroll - CHROME_PX, canvas)
+        frames = len(scrolls)
+        print("  {:6d} commands  scan {:7.3f} ms/frame  "
+              "indexed {:6.3f} ms/frame".format(
+                  len(commands), timed(scan) * 1000 / frames,
+                  timed(indexed) * 1000 / frames))
+    if root:
+        root.destroy()
+
+
+# counts canvas calls when there is no display to draw on
+class CountingCanvas:
+    def __init__(self):
+        self.calls = 0
+
+    def call(self, *args, **kwargs):
+        self.calls += 1
+        return self.calls
+
+    create_text = create_rectangle = create_line = call
+    delete = move = tag_lower = tag_raise = call
+
+
+def bench_retained():
+    from display import SCROLL_STEP
+    from displayList import DisplayList, PageDrawing
+    print("scrolling down a page one step per frame")
+    root = setup_fonts()
+    if root is False:
+        return
+    display_list = DisplayList()
+    layout_document(make_styled_tree(2000)).paint(display_list)
+    frames = 200
+
+    def scroll_frames(canvas, redraw):
+        drawing = PageDrawing()
+        for frame in range(frames):
+            if redraw:
+                canvas.delete("all")
+                drawing.forget()
+            drawing.draw(canvas, display_list, frame * SCROLL_STEP)
+            if root:
+                root.update()
+
+    for name, redraw in [("redraw everything", True),
+                         ("retained items", False)]:
+        if root:
+            import tkinter
+            canvas = tkinter.Canvas(root)
+        else:
+            canvas = CountingCanvas()
+        seconds = timed(lambda: scroll_frames(canvas, redraw), repeat=1)
+        if root:
+            print("  {:18s} {:7.3f} ms/frame".format(
+                name, seconds * 1000 / frames))
+            canvas.destroy()
+        else:
+            print("  {:18s} {:7.1f} canvas calls/frame".format(
+                name, canvas.calls / frames))
+    if root:
+        root.destroy()
+
+
+def bench_typing():
+    import tabs
+    from htmlParser import HTMLParser
+    from cssParser import StyleSheet, tree_to_list
+    from jsContext import JSContext
+    print("typing into an input at the top of the page")
+    root = setup_fonts()
+    if root is False:
+        return
+    for paragraphs in [500, 2000, 8000]:
+        tab = tabs.Tab()
+        tab.lazy_layout = False
+        body = make_document(paragraphs).replace(
+            "<h2>", "<p>Search <input> here</p><h2>", 1)
+        tab.nodes = HTMLParser(body).parse()
+        tab.rules = list(tab.default_style_sheet)
+        tab.stylesheet = StyleSheet(tab.rules)
+        with contextlib.redirect_stdout(io.StringIO()):
+            tab.render()
+        tab.js = JSContext(tab)
+        tab.focus = [node for node in tree_to_list(tab.nodes, [])
+                     if getattr(node, "tag", None) == "input"][0]
+        tab.focus.attributes["value"] = ""
+        commands = len(tab.display_list)
+
+        def type_text():
+            for char in "hello world":
+                tab.keypress(char)
+        seconds = timed(type_text)
+        print("  {:6d} commands  {:6.3f} ms/keystroke  ({} commands "
+              "after)".format(commands, seconds * 1000 / 11,
+                              len(tab.display_list)))
+    if root:
+        root.destroy()
+
+
+# a click handler that rewrites every list item
+MUTATION_SCRIPT = """
+var items = document.querySelectorAll("li");
+document.querySelectorAll("h2")[0].addEventListener("click", function() {
+    for (var i = 0; i < items.length; i++) {
+        items[i].innerHTML = "item <b>" + i + "</b> updated";
+    }
+});
+"""
+
+
+def bench_mutations():
+    import tabs
+    from htmlParser import HTMLParser
+    from cssParser import StyleSheet, tree_to_list
+    from jsContext import JSContext
+    print("a click handler setting innerHTML on every list item")
+    root = setup_fonts()
+    if root is False:
+        return
+    for paragraphs in [10, 50, 200]:
+        tab = tabs.Tab()
+        tab.nodes = HTMLParser(make_document(paragraphs)).parse()
+        tab.rules = list(tab.default_style_sheet)
+        tab.stylesheet = StyleSheet(tab.rules)
+        with contextlib.redirect_stdout(io.StringIO()):
+            tab.render()
+            tab.js = JSContext(tab)
+            tab.js.run(MUTATION_SCRIPT)
+            heading = [node for node in tree_to_list(tab.nodes, [])
+                       if getattr(node, "tag", None) == "h2"][0]
+            renders = tab.renders
+            start = time.perf_counter()
+            tab.js.dispatch_event("click", heading)
+            seconds = time.perf_counter() - start
+        print("  {:4d} innerHTML sets  {:2d} render(s)  {:7.1f} ms".format(
+            2 * paragraphs, tab.renders - renders, seconds * 1000))
+    if root:
+        root.destroy()
+
+
+def bench_events():
+    from htmlParser import HTMLParser
+    from cssParser import tree_to_list
+    from jsContext import JSContext
+
+    class Tab:
+        def flush_render(self):
+            pass
+
+    print("dispatching 1000 keydown events")
+    tab = Tab()
+    tab.nodes = HTMLParser(make_document(10)).parse()
+    tab.js = JSContext(tab)
+    tab.js.run(MUTATION_SCRIPT)
+    heading = [node for node in tree_to_list(tab.nodes, [])
+               if getattr(node, "tag", None) == "h2"][0]
+    tab.js.run('document.querySelectorAll("h2")[0].addEventListener('
+               '"keydown", function(e) { e.preventDefault(); });')
+    handle = tab.js.get_handle(heading)
+    # what every event cost before listeners were tracked
+    code = "new Node(dukpy.handle).dispatchEvent(new Event(dukpy.type))"
+    always = timed(lambda: [tab.js.interp.evaljs(
+        code, type="keydown", handle=handle) for i in range(1000)])
+    listener = timed(lambda: [tab.js.dispatch_event("keydown", heading)
+                              for i in range(1000)])
+    none = timed(lambda: [tab.js.dispatch_event("keydown", tab.nodes)
+                          for i in range(1000)])
+    print("  every event evaluated {:7.2f} ms".format(always * 1000))
+    print("  with a listener       {:7.2f} ms".format(listener * 1000))
+    print("  without listeners     {:7.2f} ms".format(none * 1000))
+
+
+def bench_snapshot():
+    from htmlParser import HTMLParser
+    from snapshotCache import SnapshotCache
+    print("loading a parsed document snapshot vs parsing it")
+    with tempfile.TemporaryDirectory() as directory:
+        snapshots = SnapshotCache(directory)
+        for paragraphs in [4000, 8000, 16000]:
+            body = make_document(paragraphs)
+            snapshots.document(body)
+            parse = timed(lambda: HTMLParser(body).parse())
+            load = timed(lambda: snapshots.document(body))
+            print("  {:6.2f} MB  parse {:7.1f} ms  snapshot {:7.1f} ms".format(
+                len(body) / 1e6, parse * 1000, load * 1000))
+
+
+BENCHMARKS = {
+    "parser": bench_parser,
+    "memory": bench_memory,
+    "descendant": bench_descendant,
+    "sharing": bench_style_sharing,
+    "layout": bench_layout,
+    "lazy": bench_lazy_layout,
+    "scroll": bench_scroll,
+    "retained": bench_retained,
+    "typing": bench_typing,
+    "snapshot": bench_snapshot,
+    "mutations": bench_mutations,
+    "events": bench_events,
+}
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()
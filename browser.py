@@ -2,7 +2,8 @@
 import tkinter
 import tkinter.font
 from tabs import Tab
-from display import get_font, WIDTH, HEIGHT, CHROME_PX
+from display import get_font, WIDTH, HEIGHT, CHROME_PX, SCROLL_STEP
+from frameScheduler import FrameScheduler
 
 
 class Browser:
@@ -29,20 +30,30 @@ class Browser:
         self.active_tab = None
         self.focus = None
         self.address_bar = ""
+        # tab whose page is on the canvas, and what the chrome shows
+        self.drawn_tab = None
+        self.chrome_state = None
+        # input only changes state and asks for a frame; scrolling is
+        # added up and applied once per frame
+        self.scheduler = FrameScheduler(self.window, self.frame)
+        self.scroll_delta = 0
 
     def handle_down(self, e):
-        self.tabs[self.active_tab].scrolldown()
-        self.draw()
+        self.scroll(SCROLL_STEP)
 
     def handle_up(self, e):
-        self.tabs[self.active_tab].scrollup()
-        self.draw()
+        self.scroll(-SCROLL_STEP)
 
     def handle_on_mousewheel(self, e):
-        self.tabs[self.active_tab].on_mousewheel(e)
-        self.draw()
+        self.scroll(-5*(e.delta))
+
+    def scroll(self, dy):
+        self.scroll_delta += dy
+        self.scheduler.request()
 
     def handle_click(self, e):
+        # act on what is on screen
+        self.scheduler.flush()
         if e.y < CHROME_PX:
             self.focus = None
             if 40 <= e.x < 40 + 80 * len(self.tabs) and 0 <= e.y < 40:
@@ -57,7 +68,7 @@ class Browser:
         else:
             self.focus = "content"
             self.tabs[self.active_tab].click(e.x, e.y - CHROME_PX)
-        self.draw()
+        self.scheduler.request()
 
     def handle_key(self, e):
         if len(e.char) == 0:
@@ -66,32 +77,64 @@ class Browser:
             return
         if self.focus == "address bar":
             self.address_bar += e.char
-            self.draw()
+            self.scheduler.request()
         elif self.focus == "content":
             self.tabs[self.active_tab].keypress(e.char)
-            self.draw()
+            self.scheduler.request()
 
     def handle_enter(self, e):
         if self.focus == "address bar":
+            self.scheduler.flush()
             self.tabs[self.active_tab].load(self.address_bar)
             self.focus = None
-            self.draw()
+            self.scheduler.request()
 
-    # call new_tabs load method, add it to tabs list
+    # add a new tab to tabs list, then call its load method
     def load(self, url="file://browser.html"):
-        new_tab = Tab()
-        new_tab.load(url)
+        new_tab = Tab(self.draw_now)
         self.active_tab = len(self.tabs)
         self.tabs.append(new_tab)
+        new_tab.load(url)
+        self.scheduler.request()
+
+    # used by tabs to show a page that is still loading
+    def draw_now(self):
         self.draw()
+        self.window.update_idletasks()
+
+    # run by the scheduler at most once per frame
+    def frame(self):
+        if self.scroll_delta:
+            self.tabs[self.active_tab].scroll_by(self.scroll_delta)
+            self.scroll_delta = 0
+        self.draw()
+
+    # frame times and input latency, see FrameScheduler.stats
+    def frame_stats(self):
+        return self.scheduler.stats()
 
     # call draw method of active tab, then draw the browser's UI
+    # both keep their canvas items between frames
     def draw(self):
 
         self.window.title = "Karan's Browser"
-        self.canvas.delete("all")
+        tab = self.tabs[self.active_tab]
+        if tab is not self.drawn_tab:
+            tab.forget_drawing()
+            self.drawn_tab = tab
         # calls active tab's draw method
-        self.tabs[self.active_tab].draw(self.canvas)
+        tab.draw(self.canvas)
+
+        # the chrome is only drawn again when what it shows changed
+        chrome_state = (len(self.tabs), self.active_tab, self.focus,
+                        self.address_bar, tab.url)
+        if chrome_state != self.chrome_state:
+            self.chrome_state = chrome_state
+            self.canvas.delete("chrome")
+            self.draw_chrome()
+        self.canvas.tag_raise("chrome")
+
+    def draw_chrome(self):
         # Here onwards: draw browser's UI
         bgcolor = "#00123b"
         bgsecondary = "#16407a"
@@ -100,7 +143,8 @@ class Browser:
 
         # search and tabs area
         self.canvas.create_rectangle(0, 0, WIDTH, CHROME_PX,
-                                     fill=bgcolor, outline=bgcolor)
+                                     fill=bgcolor, outline=bgcolor,
+                                     tags="chrome")
 
         # tab box
         tabfont = get_font(18, "normal", "roman")
@@ -110,21 +154,27 @@ class Browser:
             # active tab
             if i == self.active_tab:
                 self.canvas.create_rectangle(x1, 0, x2, 40, fill=bgsecondary,
-                                             outline=bgsecondary)
+                                             outline=bgsecondary,
+                                             tags="chrome")
             else:
                 # vertical lines and tab name
-                self.canvas.create_line(x1, 10, x1, 30, fill=linegrey)
-                self.canvas.create_line(x2, 10, x2, 30, fill=linegrey)
+                self.canvas.create_line(x1, 10, x1, 30, fill=linegrey,
+                                        tags="chrome")
+                self.canvas.create_line(x2, 10, x2, 30, fill=linegrey,
+                                        tags="chrome")
             self.canvas.create_text(x1 + 10, 10, anchor="nw", text=name,
-                                    font=tabfont, fill=linewhite)
+                                    font=tabfont, fill=linewhite,
+                                    tags="chrome")
 
         #  + button
         buttonfont = get_font(22, "normal", "roman")
         self.canvas.create_text(13, 6, anchor="nw", text="+",
-                                font=buttonfont, fill=linewhite)
+                                font=buttonfont, fill=linewhite,
+                                tags="chrome")
 
         self.canvas.create_rectangle(0, 41, WIDTH, CHROME_PX,
-                                     fill=bgsecondary, outline=bgsecondary)
+                                     fill=bgsecondary, outline=bgsecondary,
+                                     tags="chrome")
         # search box
         searchfont = get_font(16, "normal", "roman")
         # self.canvas.create_rectangle(40, 50, WIDTH - 10, 90, fill="#101010",
@@ -152,7 +202,8 @@ class Browser:
                       x1, y1+radius,
                       x1, y1]
 
-            return self.canvas.create_polygon(points, **kwargs, smooth=True)
+            return self.canvas.create_polygon(points, **kwargs, smooth=True,
+                                              tags="chrome")
 
         round_rectangle(40, 50, WIDTH - 120, 90, radius=50, fill="#101010",
                         outline=bgsecondary, width=1)
@@ -160,19 +211,22 @@ class Browser:
             # search bar while searching
             self.canvas.create_text(
                 55, 60, anchor='nw', text=self.address_bar,
-                font=searchfont, fill=linewhite)
+                font=searchfont, fill=linewhite, tags="chrome")
             w = searchfont.measure(self.address_bar)
             # search cursor
-            self.canvas.create_line(55 + w, 57, 55 + w, 80, fill=linewhite)
+            self.canvas.create_line(55 + w, 57, 55 + w, 80, fill=linewhite,
+                                    tags="chrome")
         else:
             # search bar view when it is not clicked on
             url = self.tabs[self.active_tab].url
             self.canvas.create_text(55, 60, anchor='nw', text=url,
-                                    font=searchfont, fill=linewhite)
+                                    font=searchfont, fill=linewhite,
+                                    tags="chrome")
 
         # back arrow
         self.canvas.create_line(
-            15, 70, 30, 70, arrow=tkinter.FIRST, fill=linewhite)
+            15, 70, 30, 70, arrow=tkinter.FIRST, fill=linewhite,
+            tags="chrome")
 
 
 if __name__ == "__main__":
@@ -1,7 +1,17 @@
 
+import hashlib
+import threading
+import types
+from collections import OrderedDict
 from htmlParser import Text, Element
 from layoutParser import layout_mode, DrawRect
 
+# characters of style sheet source whose parsed rules stay cached
+# (parsed rules take roughly a constant multiple of their source's size)
+STYLESHEET_CACHE_SIZE = 4 * 1024 * 1024
+# selectors kept parsed for querySelectorAll
+SELECTOR_CACHE_SIZE = 1024
+
 
 # convert variable to absolute path
 def resolve_url(url, current):
@@ -139,6 +149,84 @@ class CSSParser:
         return rules
 
 
+# parsed rule lists shared by every tab, keyed by URL and a hash of the
+# source, so the same style sheet is only parsed once per process
+# the cached lists are tuples with read-only bodies: don't modify them
+class StyleSheetCache:
+    def __init__(self, max_size=STYLESHEET_CACHE_SIZE):
+        self.max_size = max_size
+        # {(url, sha1 of source): (rules, size)}, least recently used first
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def parse(self, source, url=None):
+        key = (url, hashlib.sha1(source.encode("utf8")).hexdigest())
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        rules = tuple((selector, types.MappingProxyType(body))
+                      for selector, body in load_rules(source))
+        with self.lock:
+            if key not in self.entries:
+                self.entries[key] = (rules, len(source))
+                self.size += len(source)
+            while self.size > self.max_size and len(self.entries) > 1:
+                _, (_, size) = self.entries.popitem(last=False)
+                self.size -= size
+        return rules
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self.entries),
+                "size": self.size,
+            }
+
+
+STYLESHEET_CACHE = StyleSheetCache()
+
+
+# {selector text: selector}, least recently used first
+SELECTOR_CACHE = OrderedDict()
+
+
+# parse a selector, reusing the selector object for text seen before
+# (selectors are never changed once parsed)
+def parse_selector(text):
+    selector = SELECTOR_CACHE.get(text)
+    if selector is not None:
+        SELECTOR_CACHE.move_to_end(text)
+        return selector
+    selector = CSSParser(text).selector()
+    SELECTOR_CACHE[text] = selector
+    if len(SELECTOR_CACHE) > SELECTOR_CACHE_SIZE:
+        SELECTOR_CACHE.popitem(last=False)
+    return selector
+
+
+# parse source, or load its rules from the on-disk snapshot cache if
+# that is turned on
+def load_rules(source):
+    import snapshotCache
+    if snapshotCache.SNAPSHOTS:
+        return snapshotCache.SNAPSHOTS.rules(source)
+    return CSSParser(source).parse()
+
+
+# parse a style sheet through the process-wide cache
+def parse_stylesheet(source, url=None):
+    return STYLESHEET_CACHE.parse(source, url)
+
+
 # converts input word into a tagselector object
 # later we can pass other nodes to match method to see if they have
 # the same tag
@@ -174,6 +262,8 @@ class DescendantSelector:
         self.ancestor = ancestor
         self.descendant = descendant
         self.priority = ancestor.priority + descendant.priority
+        # tags/classes that must all be somewhere above a matching node
+        self.ancestor_keys = filter_keys(ancestor)
 
     def matches(self, node):
         if not self.descendant.matches(node):
@@ -189,6 +279,122 @@ class DescendantSelector:
             .format(self.ancestor, self.descendant, self.priority)
 
 
+# tags and classes a node needs in its ancestor chain (or itself)
+# for selector to match it
+def filter_keys(selector):
+    if isinstance(selector, DescendantSelector):
+        return selector.ancestor_keys + filter_keys(selector.descendant)
+    if isinstance(selector, TagSelector):
+        return [selector.tag]
+    if isinstance(selector, ClassSelector):
+        return [selector.cls]
+    return []
+
+
+# counts the tags and classes of the ancestors of the node being styled,
+# so a descendant selector whose ancestor can't be there is rejected
+# without walking up the parent chain
+class AncestorFilter:
+    def __init__(self):
+        self.counts = {}
+
+    # filter for the ancestors of node
+    @classmethod
+    def above(cls, node):
+        ancestors = cls()
+        node = node.parent
+        while node:
+            ancestors.push(node)
+            node = node.parent
+        return ancestors
+
+    def push(self, node):
+        for key in (node.tag, node.cls):
+            if key is not None:
+                self.counts[key] = self.counts.get(key, 0) + 1
+
+    def pop(self, node):
+        for key in (node.tag, node.cls):
+            if key is not None:
+                self.counts[key] -= 1
+                if not self.counts[key]:
+                    del self.counts[key]
+
+    def may_contain(self, keys):
+        for key in keys:
+            if key not in self.counts:
+                return False
+        return True
+
+
+# rules are filed under the tag or class their selector's rightmost part
+# needs; a node can only match rules filed under its own tag or class
+def rule_key(selector):
+    if isinstance(selector, DescendantSelector):
+        selector = selector.descendant
+    if isinstance(selector, TagSelector):
+        return "tag", selector.tag
+    if isinstance(selector, ClassSelector):
+        return "class", selector.cls
+    return None
+
+
+# rules sorted into cascade order once and indexed by rule_key,
+# so style() only tests the rules that could match each node
+class StyleSheet:
+    def __init__(self, rules):
+        self.rules = sorted(rules, key=cascade_priority)
+        self.by_tag = {}
+        self.by_class = {}
+        # rules with any other kind of selector are tried on every element
+        self.universal = []
+        for index, (selector, body) in enumerate(self.rules):
+            key = rule_key(selector)
+            if key is None:
+                self.universal.append(index)
+            elif key[0] == "tag":
+                self.by_tag.setdefault(key[1], []).append(index)
+            else:
+                self.by_class.setdefault(key[1], []).append(index)
+        # {(tag, cls): candidate rules in cascade order}
+        self.candidate_cache = {}
+        # computed styles shared between nodes, see style_tree
+        self.style_cache = {}
+        self.style_hits = 0
+        self.style_misses = 0
+
+    def candidates(self, node):
+        if not isinstance(node, Element):
+            return []
+        key = (node.tag, node.cls)
+        rules = self.candidate_cache.get(key)
+        if rules is None:
+            indices = self.by_tag.get(node.tag, []) + self.universal
+            if node.cls is not None:
+                indices = indices + self.by_class.get(node.cls, [])
+            rules = [self.rules[i] for i in sorted(indices)]
+            self.candidate_cache[key] = rules
+        return rules
+
+    def sharing_stats(self):
+        lookups = self.style_hits + self.style_misses
+        return {
+            "hits": self.style_hits,
+            "misses": self.style_misses,
+            "hit_rate": self.style_hits / lookups if lookups else 0.0,
+            "shared_styles": len(self.style_cache),
+        }
+
+
+# a node's computed style; shared between nodes, so it must not change
+class ComputedStyle(dict):
+    def readonly(self, *args, **kwargs):
+        raise TypeError("computed styles are shared and can't be modified")
+
+    __setitem__ = __delitem__ = readonly
+    clear = pop = popitem = setdefault = update = readonly
+
+
 INHERITED_PROPERTIES = {
     "font-size": "16px",
     "font-style": "normal",
@@ -217,20 +423,62 @@ def compute_style(node, property, value):
         return value
 
 # for nodes passed, adds a style dictionary {prop1: v1}
+# rules is a StyleSheet (or a plain list of rules, compiled on the spot)
+def style(node, rules):
+    if not isinstance(rules, StyleSheet):
+        rules = StyleSheet(rules)
+    style_tree(node, rules, AncestorFilter.above(node))
 
 
-def style(node, rules):
-    node.style = {}
+# style node and its subtree; ancestors holds node's ancestor chain
+def style_tree(node, rules, ancestors):
+    node.style = shared_style(node, rules, ancestors)
+    # apply same style rules on each child as well
+    if node.children:
+        ancestors.push(node)
+        for child in node.children:
+            style_tree(child, rules, ancestors)
+        ancestors.pop(node)
+
+
+# nodes with the same tag, class and style attribute under parents with
+# the same computed style object get the same computed style: by
+# induction their ancestors have the same tags and classes all the way
+# up, so they match exactly the same rules
+def shared_style(node, rules, ancestors):
+    parent_style = node.parent.style if node.parent else None
+    if isinstance(node, Element):
+        key = (node.tag, node.cls, node.attributes.get("style"),
+               id(parent_style))
+    else:
+        key = (None, None, None, id(parent_style))
+    entry = rules.style_cache.get(key)
+    # the cached parent is kept alive, so a matching id means same object
+    if entry and entry[0] is parent_style:
+        rules.style_hits += 1
+        return entry[1]
+    rules.style_misses += 1
+    computed = ComputedStyle(compute_node_style(node, rules, ancestors))
+    rules.style_cache[key] = (parent_style, computed)
+    return computed
+
+
+def compute_node_style(node, rules, ancestors):
+    style = {}
     # for item in inherited_properties
     # if parent has a specific value then inherit it,
     # else get the default value for that property
     for property, default_value in INHERITED_PROPERTIES.items():
         if node.parent:
-            node.style[property] = node.parent.style[property]
+            style[property] = node.parent.style[property]
         else:
-            node.style[property] = default_value
-    # for each property in browser.css: compute its style for this element
-    for selector, body in rules:
+            style[property] = default_value
+    # for each rule that could apply: compute its style for this element
+    for selector, body in rules.candidates(node):
+        # a descendant selector needing an ancestor we don't have
+        if isinstance(selector, DescendantSelector) and \
+                not ancestors.may_contain(selector.ancestor_keys):
+            continue
         # skip if property is not for this element
         if not selector.matches(node):
             continue
@@ -240,18 +488,16 @@ def style(node, rules):
             computed_value = compute_style(node, property, value)
             if not computed_value:
                 continue
-            node.style[property] = computed_value
+            style[property] = computed_value
     # support for "style property"
     if isinstance(node, Element) and "style" in node.attributes:
         pairs = CSSParser(node.attributes["style"]).body()
         for property, value in pairs.items():
             computed_value = compute_style(node, property, value)
-            node.style[property] = computed_value
+            style[property] = computed_value
     if isinstance(node, Element) and node.tag == "pre":
-        node.style["font-family"] = "Courier"
-    # apply same style rules on each child as well
-    for child in node.children:
-        style(child, rules)
+        style["font-family"] = "Courier"
+    return style
 
 
 def cascade_priority(rule):
@@ -267,15 +513,17 @@ class DrawText:
         self.font = font
         self.color = color
 
-        self.bottom = y1 + font.metrics("linespace")
+        self.bottom = y1 + font.linespace
 
-    def execute(self, scroll, canvas):
-        canvas.create_text(
+    # returns the canvas item
+    def execute(self, scroll, canvas, tags=()):
+        return canvas.create_text(
             self.left, self.top - scroll,
             text=self.text,
             font=self.font,
             anchor='nw',
             fill=self.color,
+            tags=tags,
         )
 
     def __repr__(self):
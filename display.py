@@ -1,20 +1,215 @@
-
-
-import tkinter
-import tkinter.font
+import json
+import os
+from collections import OrderedDict
 
 SCROLL_STEP = 100
 CHROME_PX = 100
 HSTEP, VSTEP = 13, 18
 WIDTH, HEIGHT = 800, 600
 INPUT_WIDTH_PX = 200
+# lazy layout goes this far below the bottom of the viewport
+LAYOUT_OVERSCAN = HEIGHT
+# page items are kept on the canvas until this far out of view
+DRAW_RETAIN_PX = 2 * HEIGHT
+# the browser draws at most this many frames a second
+FRAME_RATE = 60
+# (font, word) widths remembered by measure()
+WORD_CACHE_SIZE = 100000
+
+# characters whose advances go into headless metrics tables
+TABLE_CHARS = [chr(c) for c in range(0x20, 0x7f)] + \
+    [chr(c) for c in range(0xa0, 0x100)]
+TABLE_SIZES = range(1, 101)
+TABLE_WEIGHTS = ["normal", "bold"]
+TABLE_SLANTS = ["roman", "italic"]
 
 FONTS = {}
+# {(font key, word): width}, least recently used first
+WORD_WIDTHS = OrderedDict()
+MEASURE_STATS = {"hits": 0, "misses": 0}
+
+
+# a Tk font with its metrics read once and word widths cached, since
+# every Tk measurement is a round trip into the Tk interpreter
+# passed to the canvas it acts like the Tk font (by name)
+class CachedFont:
+    def __init__(self, key, font):
+        self.key = key
+        self.font = font
+        self.cached_metrics = font.metrics()
+        self.ascent = self.cached_metrics["ascent"]
+        self.descent = self.cached_metrics["descent"]
+        self.linespace = self.cached_metrics["linespace"]
+        self.space = font.measure(" ")
+
+    def measure(self, text):
+        return measure(self, text)
+
+    def metrics(self, *options):
+        if len(options) == 1:
+            return self.cached_metrics[options[0]]
+        return dict(self.cached_metrics)
+
+    def __str__(self):
+        return str(self.font)
+
+
+# metrics providers create the fonts get_font hands to layout:
+# objects with measure(text) and metrics(*options) like a Tk font
+
+
+# real Tk fonts (needs a Tk root, so an X display)
+class TkMetrics:
+    def create_font(self, size, weight, slant):
+        import tkinter.font
+        return tkinter.font.Font(size=size, weight=weight, slant=slant)
+
+
+# fonts measured from a table of per-glyph advances saved from Tk by
+# dump_metrics_table, so layout runs without Tk or a display
+# Tk measures a string as the sum of its glyph advances, so display
+# lists come out the same as with TkMetrics for the tabled fonts and
+# characters (TABLE_CHARS: printable Latin-1; anything else is
+# measured as "?")
+# fonts the table lacks are approximated rather than refused: sizes
+# are scaled from the nearest tabled size (so widths may be off by a
+# pixel per glyph), an oblique slant is taken as italic, and other
+# slants and weights as roman and normal
+class HeadlessMetrics:
+    def __init__(self, path):
+        with open(path) as f:
+            table = json.load(f)
+        self.fonts = {}
+        for entry in table["fonts"]:
+            key = (entry["size"], entry["weight"], entry["slant"])
+            self.fonts[key] = entry
+
+    def create_font(self, size, weight, slant):
+        if slant == "oblique":
+            slant = "italic"
+        if slant not in TABLE_SLANTS:
+            slant = "roman"
+        if weight not in TABLE_WEIGHTS:
+            weight = "normal"
+        key = (size, weight, slant)
+        if key in self.fonts:
+            return GlyphFont(self.fonts[key])
+        sizes = [s for s, w, sl in self.fonts if (w, sl) == (weight, slant)]
+        if not sizes:
+            raise KeyError("No metrics for {} {} fonts in the table".format(
+                weight, slant))
+        nearest = min(sizes, key=lambda s: abs(s - size))
+        # Tk takes size 0 as its default size; don't scale to nothing
+        scale = size / nearest if size > 0 else 1
+        return GlyphFont(self.fonts[(nearest, weight, slant)], scale)
+
+
+class GlyphFont:
+    def __init__(self, entry, scale=1):
+        self.name = "{size} {weight} {slant}".format(**entry)
+        self.advances = entry["advances"]
+        if scale != 1:
+            self.name = "{} {weight} {slant}".format(
+                round(entry["size"] * scale), **entry)
+            self.advances = {c: round(advance * scale)
+                             for c, advance in self.advances.items()}
+        # characters missing from the table measure like "?"
+        self.missing = self.advances.get("?", 0)
+        self.font_metrics = {
+            "ascent": round(entry["ascent"] * scale),
+            "descent": round(entry["descent"] * scale),
+            "linespace": round(entry["linespace"] * scale),
+            "fixed": entry["fixed"],
+        }
+
+    def measure(self, text):
+        advances = self.advances
+        missing = self.missing
+        return sum([advances.get(c, missing) for c in text])
+
+    def metrics(self, *options):
+        if len(options) == 1:
+            return self.font_metrics[options[0]]
+        return dict(self.font_metrics)
+
+    def __str__(self):
+        return self.name
+
+
+# headless when BROWSER_FONT_METRICS names a table, Tk otherwise
+if os.environ.get("BROWSER_FONT_METRICS"):
+    METRICS = HeadlessMetrics(os.environ["BROWSER_FONT_METRICS"])
+else:
+    METRICS = TkMetrics()
+
+
+def set_metrics_provider(provider):
+    global METRICS
+    METRICS = provider
+    FONTS.clear()
+    WORD_WIDTHS.clear()
+
+
+def is_headless():
+    return not isinstance(METRICS, TkMetrics)
 
 
 def get_font(size, weight, slant):
     key = (size, weight, slant)
     if key not in FONTS:
-        font = tkinter.font.Font(size=size, weight=weight, slant=slant)
-        FONTS[key] = font
+        font = METRICS.create_font(size, weight, slant)
+        FONTS[key] = CachedFont(key, font)
     return FONTS[key]
+
+
+# measure every TABLE_CHARS glyph of every font with Tk and save the
+# table HeadlessMetrics reads
+def dump_metrics_table(path):
+    import tkinter
+    import tkinter.font
+    root = tkinter.Tk()
+    root.withdraw()
+    fonts = []
+    for size in TABLE_SIZES:
+        for weight in TABLE_WEIGHTS:
+            for slant in TABLE_SLANTS:
+                font = tkinter.font.Font(size=size, weight=weight,
+                                         slant=slant)
+                entry = {"size": size, "weight": weight, "slant": slant}
+                entry.update(font.metrics())
+                entry["advances"] = {c: font.measure(c) for c in TABLE_CHARS}
+                fonts.append(entry)
+    root.destroy()
+    with open(path, "w") as f:
+        json.dump({"fonts": fonts}, f)
+
+
+# width of word in font, through a bounded LRU cache
+def measure(font, word):
+    key = (font.key, word)
+    width = WORD_WIDTHS.get(key)
+    if width is not None:
+        WORD_WIDTHS.move_to_end(key)
+        MEASURE_STATS["hits"] += 1
+        return width
+    MEASURE_STATS["misses"] += 1
+    width = font.font.measure(word)
+    WORD_WIDTHS[key] = width
+    if len(WORD_WIDTHS) > WORD_CACHE_SIZE:
+        WORD_WIDTHS.popitem(last=False)
+    return width
+
+
+def measure_stats():
+    lookups = MEASURE_STATS["hits"] + MEASURE_STATS["misses"]
+    return dict(MEASURE_STATS,
+                hit_rate=MEASURE_STATS["hits"] / lookups if lookups else 0.0,
+                cached_words=len(WORD_WIDTHS), fonts=len(FONTS))
+
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) == 3 and sys.argv[1] == "dump-metrics":
+        dump_metrics_table(sys.argv[2])
+    else:
+        print("usage: python3 display.py dump-metrics <table.json>")
@@ -0,0 +1,123 @@
+import bisect
+from display import HEIGHT, CHROME_PX, DRAW_RETAIN_PX
+
+# height of the horizontal bands of the page that commands are filed under
+TILE_HEIGHT = 256
+
+
+# the draw commands of a page in paint order, each one also filed under
+# every tile (band of TILE_HEIGHT pixels) it overlaps, so the commands in
+# view are found without looking at the rest of the page
+class DisplayList:
+    def __init__(self):
+        self.commands = []
+        # {tile number: [command index, ...]} in paint order
+        self.tiles = {}
+        # commands taken out by replace() that may still be on a canvas
+        self.removed = []
+
+    def append(self, cmd):
+        index = len(self.commands)
+        self.commands.append(cmd)
+        for tile in tile_range(cmd.top, cmd.bottom):
+            if tile in self.tiles:
+                self.tiles[tile].append(index)
+            else:
+                self.tiles[tile] = [index]
+
+    def extend(self, cmds):
+        for cmd in cmds:
+            self.append(cmd)
+
+    # put cmd in place of the command at index (same place in paint order)
+    def replace(self, index, cmd):
+        old = self.commands[index]
+        for tile in tile_range(old.top, old.bottom):
+            self.tiles[tile].remove(index)
+            if not self.tiles[tile]:
+                del self.tiles[tile]
+        self.commands[index] = cmd
+        self.removed.append(old)
+        for tile in tile_range(cmd.top, cmd.bottom):
+            if tile in self.tiles:
+                bisect.insort(self.tiles[tile], index)
+            else:
+                self.tiles[tile] = [index]
+
+    def __len__(self):
+        return len(self.commands)
+
+    def __iter__(self):
+        return iter(self.commands)
+
+    def __getitem__(self, index):
+        return self.commands[index]
+
+    # commands overlapping the part of the page from top to bottom,
+    # in paint order
+    def visible(self, top, bottom):
+        indices = set()
+        for tile in tile_range(top, bottom):
+            if tile in self.tiles:
+                indices.update(self.tiles[tile])
+        commands = self.commands
+        return [commands[i] for i in sorted(indices)
+                if commands[i].top <= bottom and commands[i].bottom >= top]
+
+    def __repr__(self):
+        return "DisplayList({} commands)".format(len(self.commands))
+
+
+# a display list drawn on a canvas, with the canvas items (tagged "page")
+# kept from frame to frame: scrolling moves them all, commands coming into
+# view get new items and ones far out of view are deleted
+class PageDrawing:
+    def __init__(self):
+        # {command: canvas item} for the commands drawn so far, the
+        # display list they came from and the scroll they are at
+        self.drawn = {}
+        self.display_list = None
+        self.scroll = 0
+
+    def draw(self, canvas, display_list, scroll):
+        if self.display_list is not display_list:
+            canvas.delete("page")
+            self.drawn = {}
+            self.display_list = display_list
+        elif self.scroll != scroll:
+            canvas.move("page", 0, self.scroll - scroll)
+        self.scroll = scroll
+        replaced = [self.drawn.pop(cmd) for cmd in display_list.removed
+                    if cmd in self.drawn]
+        if replaced:
+            canvas.delete(*replaced)
+        display_list.removed = []
+
+        # new items go on top, so ones painted before an item already
+        # there (scrolling up) are lowered beneath it
+        new_items = []
+        for cmd in display_list.visible(scroll, scroll + HEIGHT - CHROME_PX):
+            if cmd in self.drawn:
+                for item in new_items:
+                    canvas.tag_lower(item, self.drawn[cmd])
+                new_items = []
+            else:
+                item = cmd.execute(scroll - CHROME_PX, canvas, "page")
+                self.drawn[cmd] = item
+                new_items.append(item)
+
+        top = scroll - DRAW_RETAIN_PX
+        bottom = scroll + HEIGHT - CHROME_PX + DRAW_RETAIN_PX
+        far = [cmd for cmd in self.drawn
+               if cmd.bottom < top or cmd.top > bottom]
+        if far:
+            canvas.delete(*[self.drawn.pop(cmd) for cmd in far])
+
+    # the items are gone from the canvas (or it shows something else)
+    def forget(self):
+        self.drawn = {}
+        self.display_list = None
+
+
+def tile_range(top, bottom):
+    return range(int(top // TILE_HEIGHT), int(bottom // TILE_HEIGHT) + 1)
@@ -0,0 +1,74 @@
+from htmlParser import Element
+from cssParser import tree_to_list, rule_key
+
+
+# the elements of a document by tag and by class, so a query only tests
+# the elements its selector's rightmost part can match
+# buckets are dicts used as ordered sets; results are put back in
+# document order by their paths from the root (child numbers at each
+# level), which a change only invalidates inside the replaced subtree
+class DOMIndex:
+    def __init__(self, root):
+        self.root = root
+        # {tag or class: {element: None}}
+        self.by_tag = {}
+        self.by_class = {}
+        # {node: (child number, ...) from the root}, filled in as needed
+        self.paths = {root: ()}
+        self.add(root)
+
+    # index node and everything under it
+    def add(self, node):
+        for node in tree_to_list(node, []):
+            if not isinstance(node, Element):
+                continue
+            self.by_tag.setdefault(node.tag, {})[node] = None
+            if node.cls is not None:
+                self.by_class.setdefault(node.cls, {})[node] = None
+
+    # forget node and everything under it
+    def remove(self, node):
+        for node in tree_to_list(node, []):
+            self.paths.pop(node, None)
+            if not isinstance(node, Element):
+                continue
+            bucket = self.by_tag.get(node.tag)
+            if bucket is not None:
+                bucket.pop(node, None)
+            if node.cls is not None:
+                bucket = self.by_class.get(node.cls)
+                if bucket is not None:
+                    bucket.pop(node, None)
+
+    # is element in the indexed document (replaced subtrees keep their
+    # parent pointers, so this can't walk up to the root)
+    def contains(self, element):
+        return element in self.by_tag.get(element.tag, {})
+
+    def candidates(self, selector):
+        key = rule_key(selector)
+        if key is None:
+            return tree_to_list(self.root, [])
+        kind, value = key
+        buckets = self.by_tag if kind == "tag" else self.by_class
+        return buckets.get(value, {})
+
+    # nodes matching selector, in document order
+    def query(self, selector):
+        nodes = [node for node in self.candidates(selector)
+                 if selector.matches(node)]
+        if len(nodes) > 1:
+            nodes.sort(key=self.path)
+        return nodes
+
+    # node's path from the root; finding one numbers all its siblings
+    def path(self, node):
+        if node not in self.paths:
+            parent = self.path(node.parent)
+            for number, child in enumerate(node.parent.children):
+                self.paths[child] = parent + (number,)
+        return self.paths[node]
+
+    def __repr__(self):
+        return "DOMIndex({} tags, {} classes)".format(
+            len(self.by_tag), len(self.by_class))
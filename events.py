@@ -1,3 +1,4 @@
 
-EVENT_DISPATCH_CODE = \
-    "new Node(dukpy.handle).dispatchEvent(new Event(dukpy.type))"
+# the dispatch function is defined once in runtime10.js, so each event
+# only evaluates this call
+EVENT_DISPATCH_CODE = "__dispatchEvent(dukpy.handle, dukpy.type)"
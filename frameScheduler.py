@@ -0,0 +1,74 @@
+import time
+from display import FRAME_RATE
+
+# frame times and latencies kept for stats()
+FRAME_HISTORY = 600
+
+
+# runs draws on the Tk event loop, at most one per frame: whatever asks
+# for a redraw before the frame runs is drawn by that one frame
+class FrameScheduler:
+    def __init__(self, window, draw):
+        self.window = window
+        self.draw = draw
+        self.interval = 1 / FRAME_RATE
+        # after() id of the scheduled frame, if any
+        self.scheduled = None
+        # when the oldest request not yet drawn was made
+        self.requested = None
+        self.last_frame = 0
+        self.requests = 0
+        self.frames = 0
+        # (seconds drawing, seconds from first request to drawn)
+        self.history = []
+
+    # something changed on screen; draw it in the next frame
+    def request(self):
+        self.requests += 1
+        if self.requested is None:
+            self.requested = time.perf_counter()
+        if self.scheduled:
+            return
+        wait = self.last_frame + self.interval - time.perf_counter()
+        if wait > 0:
+            self.scheduled = self.window.after(int(wait * 1000), self.run)
+        else:
+            # still after the input events already queued
+            self.scheduled = self.window.after_idle(self.run)
+
+    # draw now if a frame is pending (e.g. before handling a click,
+    # so it lands on what is on screen)
+    def flush(self):
+        if self.scheduled:
+            self.window.after_cancel(self.scheduled)
+            self.run()
+
+    def run(self):
+        self.scheduled = None
+        start = time.perf_counter()
+        self.draw()
+        end = time.perf_counter()
+        self.last_frame = start
+        self.frames += 1
+        self.history.append((end - start, end - self.requested))
+        if len(self.history) > FRAME_HISTORY:
+            del self.history[0]
+        self.requested = None
+
+    # frame times and input latency (first request to frame drawn)
+    # over the last FRAME_HISTORY frames, in milliseconds
+    def stats(self):
+        stats = {"frames": self.frames, "requests": self.requests}
+        if self.history:
+            draws = sorted(draw for draw, latency in self.history)
+            latencies = sorted(latency for draw, latency in self.history)
+            stats["draw_ms"] = percentiles(draws)
+            stats["latency_ms"] = percentiles(latencies)
+        return stats
+
+
+# median, 95th percentile and worst of sorted seconds, in milliseconds
+def percentiles(values):
+    return {"p50": values[len(values) // 2] * 1000,
+            "p95": values[int(len(values) * 0.95)] * 1000,
+            "max": values[-1] * 1000}
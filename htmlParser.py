@@ -1,21 +1,62 @@
 
+import functools
+import gc
+import re
+import sys
+from array import array
+
+# shared by every node that can't have children (text, <br>, <img>...)
+# nodes that get children later (innerHTML) are given a new list
+EMPTY_CHILDREN = ()
+
+
+# the tree only ever grows while parsing, so cyclic garbage collection
+# passes over it are wasted (and make parse time grow faster than the
+# document); feed and close run with collection paused
+def gc_paused(f):
+    @functools.wraps(f)
+    def paused(*args, **kwargs):
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            return f(*args, **kwargs)
+        finally:
+            if gc_enabled:
+                gc.enable()
+    return paused
+
+
+# nodes use __slots__ since a big page has hundreds of thousands of them
+# style is filled in later by cssParser.style
+# style_dirty/layout_dirty mark a subtree that changed since the last
+# render and has to be restyled/laid out again (see Tab.invalidate)
 class Text:
+    __slots__ = ("text", "children", "parent", "style",
+                 "style_dirty", "layout_dirty")
+
     def __init__(self, text, parent):
         self.text = text
-        self.children = []
+        self.children = EMPTY_CHILDREN
         self.parent = parent
+        self.style_dirty = False
+        self.layout_dirty = False
 
     def __repr__(self):
         return repr(self.text)
 
 
 class Element:
-    def __init__(self, tag, attributes, parent, cls=None):
+    __slots__ = ("tag", "attributes", "children", "parent", "cls", "style",
+                 "style_dirty", "layout_dirty")
+
+    def __init__(self, tag, attributes, parent, cls=None, children=None):
         self.tag = tag
         self.attributes = attributes
-        self.children = []
+        self.children = [] if children is None else children
         self.parent = parent
         self.cls = cls
+        self.style_dirty = False
+        self.layout_dirty = False
 
     def __repr__(self):
         attrs = [" " + k + "=\"" + v + "\"" for k,
@@ -28,35 +69,112 @@ def print_tree(node, indent=0):
     for child in node.children:
         print_tree(child, indent + 2)
 
+
+# a whole document packed into flat columns instead of node objects,
+# for big documents that are kept around but not being rendered
+# nodes are stored in DFS order; parents[i] is the index of node i's
+# parent (-1 for the root), tags[i] is None for text nodes and data[i]
+# holds the text or the attributes dict
+class NodeStore:
+    def __init__(self):
+        self.tags = []
+        self.parents = array("i")
+        self.data = []
+
+    def __len__(self):
+        return len(self.tags)
+
+    @classmethod
+    def from_tree(cls, root):
+        store = cls()
+        stack = [(root, -1)]
+        while stack:
+            node, parent = stack.pop()
+            index = len(store.tags)
+            store.parents.append(parent)
+            if isinstance(node, Text):
+                store.tags.append(None)
+                store.data.append(node.text)
+            else:
+                store.tags.append(node.tag)
+                store.data.append(node.attributes)
+            for child in reversed(node.children):
+                stack.append((child, index))
+        return store
+
+    # rebuild node objects; returns the root
+    def to_tree(self):
+        nodes = []
+        for tag, parent_index, data in zip(self.tags, self.parents, self.data):
+            parent = nodes[parent_index] if parent_index >= 0 else None
+            if tag is None:
+                node = Text(data, parent)
+            else:
+                cls = None
+                if "class" in data:
+                    cls = sys.intern("." + data["class"])
+                node = Element(tag, dict(data), parent, cls)
+            if parent:
+                parent.children.append(node)
+            nodes.append(node)
+        # leaves go back to sharing the empty children sentinel
+        for node in nodes:
+            if not node.children:
+                node.children = EMPTY_CHILDREN
+        return nodes[0] if nodes else None
+
 # get html files's contents as input, converts them into a tree of elements & text
 
 
 class HTMLParser:
-    def __init__(self, body):
+    # every < or > ends the text or tag before it
+    TAG_BOUNDARY = re.compile("([<>])")
+
+    def __init__(self, body=""):
         self.body = body
         self.unfinished = []
+        # pieces of the tag or text that hasn't been closed by < or >
+        # yet, kept between feed() calls
+        self.pending = []
+        self.in_tag = False
 
     # make html tree and return its root
     def parse(self):
-        text = ""
-        in_tag = False
-        for c in self.body:
-            if c == "<":
-                in_tag = True
+        self.feed(self.body)
+        return self.close()
+
+    # parse the next piece of the document
+    # the tree built so far hangs off self.unfinished[0]
+    @gc_paused
+    def feed(self, chunk):
+        # alternating [text, boundary, text, boundary, ..., text]
+        pieces = self.TAG_BOUNDARY.split(chunk)
+        last = pieces.pop()
+        if len(pieces) > 0 and self.pending:
+            self.pending.append(pieces[0])
+            pieces[0] = "".join(self.pending)
+            self.pending = []
+        for i in range(0, len(pieces), 2):
+            text = pieces[i]
+            if pieces[i + 1] == "<":
+                self.in_tag = True
                 # if any text encountered before <
                 if text:
                     # make it text object and append to parent
                     self.add_text(text)
-                text = ""
-            elif c == ">":
-                in_tag = False
+            else:
+                self.in_tag = False
                 # when tags ends, make it element object & add node to its parent's children
                 self.add_tag(text)
-                text = ""
-            else:
-                # build a tag or text
-                text += c
-        if not in_tag and text:
+        if last:
+            self.pending.append(last)
+
+    # end of document: flush what's left and return the root
+    @gc_paused
+    def close(self):
+        text = "".join(self.pending)
+        self.pending = []
+        if not self.in_tag and text:
             # add any remaining text to the tree
             self.add_text(text)
         return self.finish()
@@ -65,16 +183,17 @@ class HTMLParser:
     # attributes property of respective Element object as a dictionary
     def get_attributes(self, text):
         parts = text.split()
-        tag = parts[0].lower()
+        # tag and attribute names repeat on every node, so share one copy
+        tag = sys.intern(parts[0].lower())
         attributes = {}
         for attrpair in parts[1:]:
             if "=" in attrpair:
                 key, value = attrpair.split("=", 1)
                 if len(value) > 2 and value[0] in ["'", "\""]:
                     value = value[1:-1]
-                attributes[key.lower()] = value
+                attributes[sys.intern(key.lower())] = value
             else:
-                attributes[attrpair.lower()] = ""
+                attributes[sys.intern(attrpair.lower())] = ""
         return tag, attributes
 
     # create text object and add it to parent's children list
@@ -87,10 +206,10 @@ class HTMLParser:
         node = Text(text, parent)
         parent.children.append(node)
 
-    SELF_CLOSING_TAGS = [
+    SELF_CLOSING_TAGS = {
         "area", "base", "br", "col", "embed", "hr", "img", "input",
         "link", "meta", "param", "source", "track", "wbr",
-    ]
+    }
 
     def add_tag(self, tag):
         tag, attributes = self.get_attributes(tag)
@@ -101,57 +220,65 @@ class HTMLParser:
 
         cls = None
         if "class" in attributes:
-            cls = "." + attributes["class"]
-            print(cls)
+            cls = sys.intern("." + attributes["class"])
 
         if tag.startswith("/"):
             if len(self.unfinished) == 1:
                 return
-            # if closing tag, add it to parent
-            node = self.unfinished.pop()
-            parent = self.unfinished[-1]
-            parent.children.append(node)
+            # if closing tag, the element is complete
+            self.unfinished.pop()
         elif tag in self.SELF_CLOSING_TAGS:
             parent = self.unfinished[-1]
-            node = Element(tag, attributes, parent, cls)
+            node = Element(tag, attributes, parent, cls, EMPTY_CHILDREN)
             parent.children.append(node)
         else:
             parent = self.unfinished[-1] if self.unfinished else None
             node = Element(tag, attributes, parent, cls)
+            # attached right away so a partially parsed tree can be shown
+            if parent:
+                parent.children.append(node)
             self.unfinished.append(node)
 
-    HEAD_TAGS = [
+    HEAD_TAGS = {
         "base", "basefont", "bgsound", "noscript",
         "link", "meta", "title", "style", "script",
-    ]
+    }
+    BODY_START_EXCEPTIONS = {"head", "body", "/html"}
+    HEAD_END_EXCEPTIONS = HEAD_TAGS | {"/head"}
 
     def implicit_tags(self, tag):
         # self close tags if not closed by developers
         # & adds html, head, body if not added by dev
+        # (only the first two open tags matter, so the open tags
+        # are looked up directly instead of copied into a list)
+        unfinished = self.unfinished
         while True:
-            open_tags = [node.tag for node in self.unfinished]
-            if open_tags == [] and tag != "html":
+            depth = len(unfinished)
+            if depth == 0:
+                if tag == "html":
+                    break
                 self.add_tag("html")
-            elif open_tags == ["html"] \
-                    and tag not in ["head", "body", "/html"]:
+            elif depth > 2 or unfinished[0].tag != "html":
+                break
+            elif depth == 1:
+                if tag in self.BODY_START_EXCEPTIONS:
+                    break
                 if tag in self.HEAD_TAGS:
                     self.add_tag("head")
                 else:
                     self.add_tag("body")
-            elif open_tags == ["html", "head"] and \
-                    tag not in ["/head"] + self.HEAD_TAGS:
+            elif unfinished[1].tag == "head" and \
+                    tag not in self.HEAD_END_EXCEPTIONS:
                 self.add_tag("/head")
             else:
                 break
 
     def finish(self):
         # if everything parsed add html at the end
-        # else add remaining alements to the tree
+        # else close remaining elements (they are already in the tree)
         if len(self.unfinished) == 0:
             self.add_tag("html")
         while len(self.unfinished) > 1:
-            node = self.unfinished.pop()
-            parent = self.unfinished[-1]
-            parent.children.append(node)
+            self.unfinished.pop()
         # return the root of the tree
         return self.unfinished.pop()
@@ -0,0 +1,292 @@
+import atexit
+import email.utils
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# BROWSER_HTTP_CACHE names another directory to keep the cache in
+CACHE_DIR = os.environ.get("BROWSER_HTTP_CACHE") or \
+    os.path.join(os.path.expanduser("~"), ".cache", "browser", "http")
+# total size of cached bodies on disk before least recently used
+# entries are evicted
+CACHE_SIZE = 50 * 1024 * 1024
+# a changed index is written out at exit, and at most this often
+# while responses are being stored
+INDEX_SAVE_SECONDS = 30
+
+# headers describing the wire format of the original response,
+# which no longer apply to the decoded body we keep on disk
+UNCACHED_HEADERS = [
+    "connection", "keep-alive", "transfer-encoding", "content-encoding",
+    "content-length", "set-cookie",
+]
+
+
+# parse Cache-Control into {directive: value or None}
+def cache_control(headers):
+    directives = {}
+    for part in headers.get("cache-control", "").split(","):
+        part = part.strip().lower()
+        if not part:
+            continue
+        if "=" in part:
+            name, value = part.split("=", 1)
+            directives[name.strip()] = value.strip().strip('"')
+        else:
+            directives[part] = None
+    return directives
+
+
+def parse_http_date(value):
+    try:
+        return email.utils.parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError, OverflowError):
+        return None
+
+
+# absolute time until which a response may be used without asking
+# the server, or 0 if it has to be revalidated every time
+def expiry_time(headers, now):
+    directives = cache_control(headers)
+    if "no-cache" in directives:
+        return 0
+    if "max-age" in directives:
+        try:
+            max_age = int(directives["max-age"])
+        except ValueError:
+            return 0
+        try:
+            age = int(headers.get("age", "0"))
+        except ValueError:
+            age = 0
+        return now + max_age - age
+    if "expires" in headers:
+        expires = parse_http_date(headers["expires"])
+        if expires is None:
+            return 0
+        date = parse_http_date(headers.get("date", ""))
+        # measure against the server's clock when it sent one
+        if date is not None:
+            return now + expires - date
+        return expires
+    return 0
+
+
+# persistent HTTP cache: response bodies live in files under directory,
+# while an in-memory index (mirrored to index.json) keeps headers,
+# validators and freshness per URL in least recently used order
+# the index is only written when it has changed (dirty), so fetches
+# don't each rewrite all of it
+class HTTPCache:
+    def __init__(self, directory=CACHE_DIR, max_size=CACHE_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        # {url: {"headers", "expires", "size", "file"}}
+        self.index = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.revalidations = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        # only one thread writes index.json at a time
+        self.save_lock = threading.Lock()
+        self.dirty = False
+        self.saved_at = time.time()
+        self.load_index()
+        atexit.register(self.save_index)
+
+    def index_path(self):
+        return os.path.join(self.directory, "index.json")
+
+    def body_path(self, entry):
+        return os.path.join(self.directory, entry["file"])
+
+    def load_index(self):
+        try:
+            with open(self.index_path()) as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return
+        for url, entry in entries:
+            if os.path.exists(self.body_path(entry)):
+                self.index[url] = entry
+                self.size += entry["size"]
+
+    def save_index(self):
+        with self.save_lock:
+            with self.lock:
+                if not self.dirty:
+                    return
+                entries = list(self.index.items())
+                self.dirty = False
+                self.saved_at = time.time()
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                tmp = self.index_path() + ".tmp"
+                with open(tmp, "w") as f:
+                    json.dump(entries, f)
+                os.replace(tmp, self.index_path())
+            except OSError:
+                pass
+
+    # save the index if it changed and wasn't saved for a while
+    def save_index_later(self):
+        if self.dirty and time.time() - self.saved_at > INDEX_SAVE_SECONDS:
+            self.save_index()
+
+    # returns the entry for url (marking it recently used) or None
+    def lookup(self, url):
+        with self.lock:
+            entry = self.index.get(url)
+            if entry:
+                self.index.move_to_end(url)
+                self.dirty = True
+            return entry
+
+    def is_fresh(self, entry):
+        return time.time() < entry["expires"]
+
+    # request headers asking the server whether our copy is still good
+    def conditional_headers(self, entry):
+        headers = {}
+        if "etag" in entry["headers"]:
+            headers["If-None-Match"] = entry["headers"]["etag"]
+        if "last-modified" in entry["headers"]:
+            headers["If-Modified-Since"] = entry["headers"]["last-modified"]
+        return headers
+
+    # serve a fresh entry without touching the network
+    def hit(self, url, entry):
+        body = self.read_body(url, entry)
+        if body is None:
+            return None
+        with self.lock:
+            self.hits += 1
+        return dict(entry["headers"]), body
+
+    # the server answered 304 Not Modified: update the stored headers
+    # and freshness, then serve the stored body
+    def revalidated(self, url, entry, headers):
+        body = self.read_body(url, entry)
+        if body is None:
+            return None
+        now = time.time()
+        with self.lock:
+            self.revalidations += 1
+            for name, value in headers.items():
+                if name not in UNCACHED_HEADERS:
+                    entry["headers"][name] = value
+            entry["expires"] = expiry_time(entry["headers"], now)
+            self.dirty = True
+        return dict(entry["headers"]), body
+
+    def read_body(self, url, entry):
+        try:
+            with open(self.body_path(entry), "rb") as f:
+                return f.read().decode("utf8")
+        except OSError:
+            self.remove(url)
+            return None
+
+    def miss(self):
+        with self.lock:
+            self.misses += 1
+
+    # store a full response if its headers allow it
+    def store(self, url, headers, body):
+        directives = cache_control(headers)
+        if "no-store" in directives:
+            self.remove(url)
+            return
+        now = time.time()
+        expires = expiry_time(headers, now)
+        validators = "etag" in headers or "last-modified" in headers
+        # nothing to gain from an entry that is already stale and
+        # can't be revalidated
+        if expires <= now and not validators:
+            self.remove(url)
+            return
+
+        data = body.encode("utf8")
+        if len(data) > self.max_size:
+            return
+        entry = {
+            "headers": {name: value for name, value in headers.items()
+                        if name not in UNCACHED_HEADERS},
+            "expires": expires,
+            "size": len(data),
+            "file": hashlib.sha256(url.encode("utf8")).hexdigest(),
+        }
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            tmp = self.body_path(entry) + ".tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, self.body_path(entry))
+        except OSError:
+            return
+        with self.lock:
+            old = self.index.pop(url, None)
+            if old:
+                self.size -= old["size"]
+            self.index[url] = entry
+            self.size += entry["size"]
+            evicted = self.evict()
+            self.dirty = True
+        for old_entry in evicted:
+            self.delete_body(old_entry)
+        self.save_index_later()
+
+    # drop least recently used entries until we fit the size budget
+    # (must be called with the lock held)
+    def evict(self):
+        evicted = []
+        while self.size > self.max_size and self.index:
+            _, entry = self.index.popitem(last=False)
+            self.size -= entry["size"]
+            evicted.append(entry)
+        return evicted
+
+    def remove(self, url):
+        with self.lock:
+            entry = self.index.pop(url, None)
+            if entry:
+                self.size -= entry["size"]
+                self.dirty = True
+        if entry:
+            self.delete_body(entry)
+
+    def delete_body(self, entry):
+        try:
+            os.remove(self.body_path(entry))
+        except OSError:
+            pass
+
+    def clear(self):
+        with self.lock:
+            entries = list(self.index.values())
+            self.index = OrderedDict()
+            self.size = 0
+            self.dirty = True
+        for entry in entries:
+            self.delete_body(entry)
+        self.save_index()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.revalidations + self.misses
+            return {
+                "hits": self.hits,
+                "revalidations": self.revalidations,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.revalidations) / lookups
+                if lookups else 0.0,
+                "entries": len(self.index),
+                "size": self.size,
+            }
+
+
+HTTP_CACHE = HTTPCache()
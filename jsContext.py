@@ -3,7 +3,8 @@
 from events import EVENT_DISPATCH_CODE
 import dukpy
 from htmlParser import HTMLParser
-from cssParser import resolve_url, tree_to_list, CSSParser
+from cssParser import resolve_url, parse_selector
+from domIndex import DOMIndex
 from network import request, url_origin
 
 
@@ -17,6 +18,8 @@ class JSContext:
                                     self.querySelectorAll)
         self.interp.export_function("getAttribute",
                                     self.getAttribute)
+        self.interp.export_function("addEventListener",
+                                    self.addEventListener)
         self.interp.export_function("innerHTML_set", self.innerHTML_set)
         self.interp.export_function("XMLHttpRequest_send",
                                     self.XMLHttpRequest_send)
@@ -25,14 +28,24 @@ class JSContext:
 
         self.node_to_handle = {}
         self.handle_to_node = {}
+        # built on the first query
+        self.dom_index = None
+        # {(handle, event type)} with listeners, kept in step with
+        # LISTENERS in runtime10.js
+        self.listeners = set()
 
     def run(self, code):
         self.interp.evaljs(code)
 
     def dispatch_event(self, type, elt):
         handle = self.node_to_handle.get(elt, -1)
+        # nothing listens, so don't go into the interpreter at all
+        if (handle, type) not in self.listeners:
+            return False
         do_default = self.interp.evaljs(
             EVENT_DISPATCH_CODE, type=type, handle=handle)
+        # one render for everything the handlers changed
+        self.tab.flush_render()
         return not do_default
 
     def get_handle(self, elt):
@@ -45,12 +58,15 @@ class JSContext:
         return handle
 
     def querySelectorAll(self, selector_text):
-        selector = CSSParser(selector_text).selector()
-        nodes = [node for node
-                 in tree_to_list(self.tab.nodes, [])
-                 if selector.matches(node)]
+        selector = parse_selector(selector_text)
+        if self.dom_index is None or self.dom_index.root is not self.tab.nodes:
+            self.dom_index = DOMIndex(self.tab.nodes)
+        nodes = self.dom_index.query(selector)
         return [self.get_handle(node) for node in nodes]
 
+    def addEventListener(self, handle, type):
+        self.listeners.add((handle, type))
+
     def getAttribute(self, handle, attr):
         elt = self.handle_to_node[handle]
         return elt.attributes.get(attr, None)
@@ -59,10 +75,19 @@ class JSContext:
         doc = HTMLParser("<html><body>" + s + "</body></html>").parse()
         new_nodes = doc.children[0].children
         elt = self.handle_to_node[handle]
+        # keep the query index in step, if elt is still in the page
+        indexed = self.dom_index and self.dom_index.contains(elt)
+        if indexed:
+            for child in elt.children:
+                self.dom_index.remove(child)
         elt.children = new_nodes
         for child in elt.children:
             child.parent = elt
-        self.tab.render()
+            if indexed:
+                self.dom_index.add(child)
+        # rendered once the script or event handler is done (or before
+        # anything needs the layout)
+        self.tab.invalidate(elt)
 
     def XMLHttpRequest_send(self, method, url, body):
         full_url = resolve_url(url, self.tab.url)
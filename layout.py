@@ -31,12 +31,12 @@ class LineLayout:
             self.height = 0
             return
 
-        max_ascent = max([word.font.metrics("ascent")
+        max_ascent = max([word.font.ascent
                           for word in self.children])
         baseline = self.y + 1.25 * max_ascent
         for word in self.children:
-            word.y = baseline - word.font.metrics("ascent")
-        max_descent = max([word.font.metrics("descent")
+            word.y = baseline - word.font.ascent
+        max_descent = max([word.font.descent
                            for word in self.children])
         self.height = 1.25 * (max_ascent + max_descent)
 
@@ -75,12 +75,12 @@ class TextLayout:
         self.width = self.font.measure(self.word)
 
         if self.previous:
-            space = self.previous.font.measure(" ")
+            space = self.previous.font.space
             self.x = self.previous.x + space + self.previous.width
         else:
             self.x = self.parent.x
 
-        self.height = self.font.metrics("linespace")
+        self.height = self.font.linespace
 
     def paint(self, display_list):
         color = self.node.style["color"]
@@ -33,20 +33,28 @@ class InputLayout:
         self.width = INPUT_WIDTH_PX
 
         if self.previous:
-            space = self.previous.font.measure(" ")
+            space = self.previous.font.space
             self.x = self.previous.x + space + self.previous.width
         else:
             self.x = self.parent.x
 
-        self.height = self.font.metrics("linespace")
+        self.height = self.font.linespace
 
     def paint(self, display_list):
+        # where its commands went, so a changed value can replace them
+        self.painted_at = len(display_list)
+        self.commands = self.draw_commands()
+        for cmd in self.commands:
+            display_list.append(cmd)
+
+    def draw_commands(self):
+        commands = []
         bgcolor = self.node.style.get("background-color",
                                       "transparent")
         if bgcolor != "transparent":
             x2, y2 = self.x + self.width, self.y + self.height
             rect = DrawRect(self.x, self.y, x2, y2, bgcolor)
-            display_list.append(rect)
+            commands.append(rect)
 
         if self.node.tag == "input":
             text = self.node.attributes.get("value", "")
@@ -54,8 +62,9 @@ class InputLayout:
             text = "button"
 
         color = self.node.style["color"]
-        display_list.append(
+        commands.append(
             DrawText(self.x, self.y, text, self.font, color))
+        return commands
 
     def __repr__(self):
         return "InputLayout(x={}, y={}, width={}, height={})".format(
@@ -78,32 +87,92 @@ class BlockLayout:
     # calculate width: parents width
     # calculate block's height: sum of height of children
     def layout(self):
-        previous = None
+        self.layout_until(None)
+
+    # lay out children in order until the next one would start below
+    # limit (None lays out everything); calling it again with a larger
+    # limit carries on where it stopped. only the last child can be left
+    # unfinished. inline layouts finished along the way are added to
+    # laid_out in paint order
+    def layout_until(self, limit, laid_out=None):
+        if self.x is None:
+            self.width = self.parent.width
+            self.x = self.parent.x
+
+            if self.previous:
+                self.y = self.previous.y + self.previous.height
+            else:
+                self.y = self.parent.y
+            # next node child to lay out, and the summed height of the
+            # finished children
+            self.next_child = 0
+            self.done_height = 0
+            self.height = 0
+            self.complete = False
+
+        last = self.children[-1] if self.children else None
+        if last and isinstance(last, BlockLayout) and not last.complete:
+            last.layout_until(limit, laid_out)
+            if not last.complete:
+                self.height = self.done_height + last.height
+                return
+            self.done_height += last.height
+            self.height = self.done_height
+
         # for each child of input node,
         # convert it to inline or block object
         # and append it to this block objects children list
-        for child in self.node.children:
+        nodes = self.node.children
+        while self.next_child < len(nodes):
+            # (the real bottom: heights leave out the gaps above headings)
+            bottom = last.y + last.height if last else self.y
+            if limit is not None and bottom > limit:
+                return
+            child = nodes[self.next_child]
+            self.next_child += 1
             if isinstance(child, Element) and child.tag == "head":
                 continue
             if layout_mode(child) == "inline":
-                next = InlineLayout(child, self, previous)
+                next = InlineLayout(child, self, last)
+                next.layout()
+                if laid_out is not None:
+                    laid_out.append(next)
             else:
-                next = BlockLayout(child, self, previous)
+                next = BlockLayout(child, self, last)
             self.children.append(next)
-            previous = next
-
-        self.width = self.parent.width
-        self.x = self.parent.x
-
-        if self.previous:
-            self.y = self.previous.y + self.previous.height
+            last = next
+            if isinstance(next, BlockLayout):
+                next.layout_until(limit, laid_out)
+                if not next.complete:
+                    self.height = self.done_height + next.height
+                    return
+            self.done_height += next.height
+            self.height = self.done_height
+        self.complete = True
+
+    # sum the children's heights again after one of them was laid out anew
+    def update_height(self):
+        heights = [child.height for child in self.children]
+        self.height = sum(heights)
+        last = self.children[-1] if self.children else None
+        if last and isinstance(last, BlockLayout) and not last.complete:
+            self.done_height = sum(heights[:-1])
         else:
-            self.y = self.parent.y
-
-        for child in self.children:
-            child.layout()
-
-        self.height = sum([child.height for child in self.children])
+            self.done_height = self.height
+
+    # height once everything is laid out, guessing that children not
+    # laid out yet are as tall as the average finished one
+    def estimated_height(self):
+        if self.complete:
+            return self.height
+        height = self.done_height
+        finished = len(self.children)
+        last = self.children[-1] if self.children else None
+        if last and isinstance(last, BlockLayout) and not last.complete:
+            height += last.estimated_height()
+            finished -= 1
+        average = self.done_height / finished if finished else VSTEP
+        return height + (len(self.node.children) - self.next_child) * average
 
     def paint(self, display_list):
         for child in self.children:
@@ -196,7 +265,7 @@ class InlineLayout:
             text = TextLayout(node, word, line, self.previous_word)
             line.children.append(text)
             self.previous_word = text
-            self.cursor_x += w + font.measure(" ")
+            self.cursor_x += w + font.space
 
     def input(self, node):
         w = INPUT_WIDTH_PX
@@ -207,7 +276,7 @@ class InlineLayout:
         line.children.append(input)
         self.previous_word = input
         font = self.get_font(node)
-        self.cursor_x += w + font.measure(" ")
+        self.cursor_x += w + font.space
 
     # From root node to end node
         # decides styles based on node's style property
@@ -239,7 +308,9 @@ class DocumentLayout:
         self.previous = None
         self.children = []
 
-    def layout(self):
+    # lays out everything, or with a limit only down to about that y;
+    # extend() lays out more later
+    def layout(self, limit=None):
         # converts input node (input to constructor) to blockLayout
         # by default
         child = BlockLayout(self.node, self, None)
@@ -248,15 +319,104 @@ class DocumentLayout:
         self.width = WIDTH - 2*HSTEP
         self.x = HSTEP
         self.y = VSTEP
+        # how far down the page has been laid out (None: all of it)
+        self.limit = limit
 
         # calls BlockLayout's layout method
-        child.layout()
-        self.height = child.height + 2*VSTEP
+        child.layout_until(limit)
+        self.update_height()
         print("documentlayout called on {}".format(self.node))
 
+    # lay out more of a partly laid out document, down to about limit
+    # returns the inline layouts that were added, in paint order
+    def extend(self, limit):
+        child = self.children[0]
+        laid_out = []
+        if child.complete:
+            return laid_out
+        self.limit = limit
+        child.layout_until(limit, laid_out)
+        self.update_height()
+        return laid_out
+
+    # the real height once laid out completely, an estimate until then
+    def update_height(self):
+        self.height = self.children[0].estimated_height() + 2*VSTEP
+
+    # lay out node's subtree again after it changed
+    # only the block or inline layout holding node is rebuilt; everything
+    # below it is shifted by the change in height and its ancestors
+    # get their heights updated
+    def relayout(self, node):
+        old = self.find_layout(node)
+        if old is None:
+            # not laid out at all (e.g. inside <head>)
+            return
+        parent = old.parent
+        if parent is self or layout_mode(old.node) == "block":
+            new = BlockLayout(old.node, parent, old.previous)
+        else:
+            new = InlineLayout(old.node, parent, old.previous)
+        index = parent.children.index(old)
+        parent.children[index] = new
+        if index + 1 < len(parent.children):
+            parent.children[index + 1].previous = new
+        if isinstance(old, BlockLayout) and not old.complete \
+                and isinstance(new, BlockLayout):
+            # the unfinished end of a partly laid out page stays partial
+            new.layout_until(self.limit)
+        else:
+            new.layout()
+
+        # later siblings start where the new layout ends; above that,
+        # each block grew by the change in height
+        dy = (new.y + new.height) - (old.y + old.height)
+        dheight = new.height - old.height
+        obj = new
+        while parent is not self:
+            for sibling in parent.children[index + 1:]:
+                shift(sibling, dy)
+            parent.update_height()
+            dy = dheight
+            obj = parent
+            parent = parent.parent
+            index = parent.children.index(obj)
+        self.update_height()
+
+    # the block or inline layout object that lays out node
+    # (inline layouts cover their whole subtree)
+    def find_layout(self, node):
+        path = []
+        while node:
+            path.append(node)
+            node = node.parent
+        path.reverse()
+        obj = self.children[0]
+        if obj.node is not path[0]:
+            return None
+        for node in path[1:]:
+            if isinstance(obj, InlineLayout):
+                return obj
+            for child in obj.children:
+                if child.node is node:
+                    obj = child
+                    break
+            else:
+                return None
+        return obj
+
     # calls inline or block object's paint method
     def paint(self, display_list):
         self.children[0].paint(display_list)
 
     def __repr__(self):
         return "DocumentLayout()"
+
+
+# move a laid out subtree down by dy pixels
+def shift(obj, dy):
+    if not dy:
+        return
+    obj.y += dy
+    for child in obj.children:
+        shift(child, dy)
@@ -0,0 +1,42 @@
+
+from cssParser import tree_to_list
+from displayList import tile_range
+
+
+# lookups into a laid out page: the layout objects under a point
+# (by page tile, like the display list) and the first layout object
+# of each node; built once per layout
+class LayoutIndex:
+    def __init__(self, document):
+        # every layout object in tree order
+        self.objects = tree_to_list(document, [])
+        # {tile number: [object index, ...]} in tree order
+        self.tiles = {}
+        # {node: first layout object laying it out}
+        self.layouts = {}
+        for index, obj in enumerate(self.objects):
+            if obj.node not in self.layouts:
+                self.layouts[obj.node] = obj
+            if not obj.height:
+                continue
+            for tile in tile_range(obj.y, obj.y + obj.height):
+                if tile in self.tiles:
+                    self.tiles[tile].append(index)
+                else:
+                    self.tiles[tile] = [index]
+
+    # the innermost (last in tree order) layout object containing x, y
+    def hit(self, x, y):
+        for tile in tile_range(y, y):
+            for index in reversed(self.tiles.get(tile, [])):
+                obj = self.objects[index]
+                if obj.x <= x < obj.x + obj.width \
+                        and obj.y <= y < obj.y + obj.height:
+                    return obj
+        return None
+
+    def layout_for(self, node):
+        return self.layouts.get(node)
+
+    def __repr__(self):
+        return "LayoutIndex({} objects)".format(len(self.objects))
@@ -33,12 +33,14 @@ class DrawRect:
         self.right = x2
         self.color = color
 
-    def execute(self, scroll, canvas):
-        canvas.create_rectangle(
+    # returns the canvas item
+    def execute(self, scroll, canvas, tags=()):
+        return canvas.create_rectangle(
             self.left, self.top - scroll,
             self.right, self.bottom - scroll,
             width=0,
             fill=self.color,
+            tags=tags,
         )
 
     def __repr__(self):
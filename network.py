@@ -1,7 +1,10 @@
-
-
+import codecs
 import socket
 import ssl
+import threading
+import time
+import zlib
+from httpCache import HTTP_CACHE
 
 
 def url_origin(url):
@@ -11,15 +14,131 @@ def url_origin(url):
 
 COOKIE_JAR = {}
 
+# keep-alive settings for the connection pool
+MAX_CONNECTIONS_PER_HOST = 6
+IDLE_TIMEOUT = 30
+# bytes read off the socket at a time while streaming a body
+READ_SIZE = 16384
+
+
+# keeps idle HTTP/1.1 sockets around per (scheme, host, port)
+# so later requests to the same origin skip the TCP and TLS handshakes
+class ConnectionPool:
+    def __init__(self, max_per_host=MAX_CONNECTIONS_PER_HOST,
+                 idle_timeout=IDLE_TIMEOUT):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        # {(scheme, host, port): [(socket, response file, last used), ...]}
+        self.idle = {}
+        # number of sockets per key, idle or in use
+        self.open = {}
+        self.lock = threading.Lock()
+        self.available = threading.Condition(self.lock)
+
+    # returns (socket, response file, reused)
+    # reuses an idle socket if there is one, otherwise opens a new one
+    # once the host is below its connection cap (waiting for a free slot)
+    def acquire(self, scheme, host, port, reuse=True):
+        key = (scheme, host, port)
+        with self.available:
+            while True:
+                self.evict_idle()
+                idle = self.idle.get(key)
+                if idle and reuse:
+                    s, response, _ = idle.pop()
+                    return s, response, True
+                if self.open.get(key, 0) < self.max_per_host:
+                    self.open[key] = self.open.get(key, 0) + 1
+                    break
+                self.available.wait(self.idle_timeout)
+        try:
+            s = connect(scheme, host, port)
+        except:
+            self.discard(key, None)
+            raise
+        return s, s.makefile("rb"), False
+
+    # hand a socket back once its response has been read completely
+    def release(self, key, s, response):
+        with self.available:
+            self.idle.setdefault(key, []).append((s, response, time.time()))
+            self.available.notify()
+
+    # close a socket that can't be reused (server closed it,
+    # body length unknown, errors) and free its slot
+    def discard(self, key, s):
+        if s:
+            s.close()
+        with self.available:
+            self.open[key] -= 1
+            self.available.notify()
+
+    # close sockets that have been idle for too long
+    # (must be called with the lock held)
+    def evict_idle(self):
+        now = time.time()
+        for key, idle in self.idle.items():
+            fresh = []
+            for s, response, last_used in idle:
+                if now - last_used > self.idle_timeout:
+                    s.close()
+                    self.open[key] -= 1
+                else:
+                    fresh.append((s, response, last_used))
+            idle[:] = fresh
+
+    def close_all(self):
+        with self.available:
+            for key, idle in self.idle.items():
+                for s, _, _ in idle:
+                    s.close()
+                    self.open[key] -= 1
+            self.idle = {}
+
+
+CONNECTION_POOL = ConnectionPool()
+
+
+def connect(scheme, host, port):
+    # create socket to talk to other computers
+    s = socket.socket(
+        # connect via internet (INET) or bluetooth, etc.
+        family=socket.AF_INET,
+        # stream communication or dgram (upper limit on data that can be sent)
+        type=socket.SOCK_STREAM,
+        proto=socket.IPPROTO_TCP,  # communication protocol
+    )
+    s.connect((host, port))
+
+    if scheme == "https":
+        ctx = ssl.create_default_context()
+        s = ctx.wrap_socket(s, server_hostname=host)
+    return s
+
 
 def request(url="file://browser.html", top_level_url="file://browser.html", payload=None):
+    headers, body = stream(url, top_level_url, payload)
+    try:
+        return headers, "".join(body)
+    finally:
+        body.close()
+
+
+# like request, but returns the body as an iterable of text chunks
+# that are read off the socket as the caller consumes them
+# the caller must close() the body when done with it (read or not),
+# so its socket goes back to the pool
+# revalidate=False skips the cache and asks for the whole response
+def stream(url="file://browser.html", top_level_url="file://browser.html", payload=None,
+           revalidate=True):
+    full_url = url
     scheme, url = url.split("://", 1)
     # support for different schemes
     if scheme == "file":
         # read file
         localfile = open("browser.html", "r")
         body = localfile.read()
-        return [], body
+        return [], StoredBody(body)
     assert scheme in ["http", "https"], \
         "Unknown scheme {}".format(scheme)
     # get host (domain) and path within domain
@@ -33,23 +152,24 @@ def request(url="file://browser.html", top_level_url="file://browser.html", payl
     if ":" in host:
         host, port = host.split(":", 1)
         port = int(port)
-    # create socket to talk to other computers
-    s = socket.socket(
-        # connect via internet (INET) or bluetooth, etc.
-        family=socket.AF_INET,
-        # stream communication or dgram (upper limit on data that can be sent)
-        type=socket.SOCK_STREAM,
-        proto=socket.IPPROTO_TCP,  # communication protocol
-    )
-    s.connect((host, port))
 
-    if scheme == "https":
-        ctx = ssl.create_default_context()
-        s = ctx.wrap_socket(s, server_hostname=host)
+    # only plain GETs go through the cache
+    cached = None
+    if not payload and revalidate:
+        cached = HTTP_CACHE.lookup(full_url)
+        if cached and HTTP_CACHE.is_fresh(cached):
+            response = HTTP_CACHE.hit(full_url, cached)
+            if response:
+                headers, body = response
+                return headers, StoredBody(body)
+            cached = None
+
     # prepare request
     method = "POST" if payload else "GET"
-    body = "{} {} HTTP/1.0\r\n".format(method, path)
+    body = "{} {} HTTP/1.1\r\n".format(method, path)
     body += "Host: {}\r\n".format(host)
+    body += "Connection: keep-alive\r\n"
+    body += "Accept-Encoding: gzip, deflate\r\n"
     if host in COOKIE_JAR:
         cookie, params = COOKIE_JAR[host]
         allow_cookie = True
@@ -63,29 +183,78 @@ def request(url="file://browser.html", top_level_url="file://browser.html", payl
     if payload:
         content_length = len(payload.encode("utf8"))
         body += "Content-Length: {}\r\n".format(content_length)
+    if cached:
+        for header, value in HTTP_CACHE.conditional_headers(cached).items():
+            body += "{}: {}\r\n".format(header, value)
 
     body += "\r\n" + (payload or "")
-    s.send(body.encode("utf8"))  # convert python strings to bytes
-    # make a file-like object to easy store all response bytes
-    response = s.makefile("r", encoding="utf8", newline="\r\n")
 
-    statusline = response.readline()
-    version, status, explanation = statusline.split(" ", 2)
-    if not status == "301":
-        assert status == "200", "{}: {}".format(status, explanation)
-    # HEADER SPECIFIC ACTIONS
-    headers = {}
-    while True:
-        line = response.readline()
-        if line == "\r\n":
-            break
-        header, value = line.split(":", 1)
-        headers[header.lower()] = value.strip()
+    key = (scheme, host, port)
+    s, response, reused = CONNECTION_POOL.acquire(scheme, host, port)
+    try:
+        s.send(body.encode("utf8"))  # convert python strings to bytes
+        statusline = response.readline().decode("utf8")
+    except OSError:
+        if not reused:
+            CONNECTION_POOL.discard(key, s)
+            raise
+        statusline = ""
+    # a pooled socket the server already closed: retry on a fresh one
+    if not statusline and reused:
+        CONNECTION_POOL.discard(key, s)
+        s, response, _ = CONNECTION_POOL.acquire(
+            scheme, host, port, reuse=False)
+        try:
+            s.send(body.encode("utf8"))
+            statusline = response.readline().decode("utf8")
+        except:
+            CONNECTION_POOL.discard(key, s)
+            raise
+
+    try:
+        status, headers, keep_alive = read_response(statusline, response)
+    except:
+        CONNECTION_POOL.discard(key, s)
+        raise
+
+    # 304 never has a body, whatever its headers say
+    if status == "304":
+        done(key, s, response, keep_alive)
+        assert cached, "304 for a request that wasn't conditional"
+        # our cached copy is still good
+        response = HTTP_CACHE.revalidated(full_url, cached, headers)
+        if response:
+            headers, body = response
+            return headers, StoredBody(body)
+        # the copy is gone (evicted or its file removed): ask for it all
+        return stream(full_url, top_level_url, revalidate=False)
+
+    body = ResponseBody(key, s, response, headers, keep_alive)
     # fixed 301 error
     if "location" in headers:
+        # read past the redirect's body so the socket can be reused
+        try:
+            for _ in body:
+                pass
+        finally:
+            body.close()
         newurl = headers["location"]
-        return request(newurl, newurl)
+        return stream(newurl, newurl)
+
+    try:
+        set_cookie(host, headers)
+    except:
+        body.close()
+        raise
+
+    if not payload:
+        HTTP_CACHE.miss()
+        body.cache_url = full_url
+    return headers, body
+
 
+# remember the cookie a response sets for host
+def set_cookie(host, headers):
     if "set-cookie" in headers:
         params = {}
         if ";" in headers["set-cookie"]:
@@ -98,10 +267,195 @@ def request(url="file://browser.html", top_level_url="file://browser.html", payl
             cookie = headers["set-cookie"]
         COOKIE_JAR[host] = (cookie, params)
 
-    assert "transfer-encoding" not in headers
-    assert "content-encoding" not in headers
 
-    body = response.read()
-    s.close()
+# hand the socket back to the pool, or close it if it can't be reused
+def done(key, s, response, keep_alive):
+    if keep_alive:
+        CONNECTION_POOL.release(key, s, response)
+    else:
+        CONNECTION_POOL.discard(key, s)
 
-    return headers, body
+
+# a response body read off its pooled socket as it is iterated
+# the socket is returned to the pool (and the response cached, if
+# cache_url is set) once the whole body has been read; closing the
+# body before that, or an error while reading it, drops the socket
+# (it can't be a generator: one that is never started can't clean up)
+class ResponseBody:
+    def __init__(self, key, s, response, headers, keep_alive):
+        self.key = key
+        self.s = s
+        self.response = response
+        self.headers = headers
+        self.keep_alive = keep_alive
+        self.cache_url = None
+        self.chunks = read_body(response, headers)
+        self.parts = []
+        self.finished = False
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.closed:
+            raise StopIteration
+        try:
+            text = next(self.chunks)
+        except StopIteration:
+            self.finished = True
+            self.close()
+            raise
+        except BaseException:
+            self.close()
+            raise
+        if self.cache_url:
+            self.parts.append(text)
+        return text
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if not self.finished:
+            CONNECTION_POOL.discard(self.key, self.s)
+            return
+        done(self.key, self.s, self.response, self.keep_alive)
+        if self.cache_url:
+            HTTP_CACHE.store(self.cache_url, self.headers,
+                             "".join(self.parts))
+
+
+# a body that is already all in memory (cache hits, local files)
+class StoredBody:
+    def __init__(self, text):
+        self.chunks = iter([text])
+
+    def __iter__(self):
+        return self.chunks
+
+    def close(self):
+        pass
+
+
+# reads status line and headers off a binary response file
+# returns status, headers and whether the socket can be reused
+# once the body has been read
+def read_response(statusline, response):
+    version, status, explanation = statusline.split(" ", 2)
+    if status not in ["301", "304"]:
+        assert status == "200", "{}: {}".format(status, explanation)
+    # HEADER SPECIFIC ACTIONS
+    headers = {}
+    while True:
+        line = response.readline().decode("utf8")
+        if line == "\r\n":
+            break
+        header, value = line.split(":", 1)
+        headers[header.lower()] = value.strip()
+
+    keep_alive = version == "HTTP/1.1" and \
+        headers.get("connection", "").lower() != "close"
+    # without chunking or a length the body ends when the server closes
+    # (304 responses never have a body)
+    if status != "304" and "content-length" not in headers \
+            and not is_chunked(headers):
+        keep_alive = False
+    return status, headers, keep_alive
+
+
+def is_chunked(headers):
+    return "chunked" in headers.get("transfer-encoding", "").lower()
+
+
+# yields the raw (still compressed) body bytes, stopping exactly at
+# the end of the body so the socket can be reused
+def read_raw_body(response, headers):
+    if is_chunked(headers):
+        while True:
+            # chunk size in hex, optionally followed by ;extensions
+            size_line = response.readline().decode("latin1")
+            size = int(size_line.split(";", 1)[0].strip(), 16)
+            if size == 0:
+                break
+            chunk = response.read(size)
+            assert len(chunk) == size, "Connection closed mid-chunk"
+            response.readline()
+            yield chunk
+        # skip trailers up to the final blank line
+        while response.readline() not in [b"\r\n", b""]:
+            pass
+    elif "content-length" in headers:
+        remaining = int(headers["content-length"])
+        while remaining > 0:
+            chunk = response.read(min(READ_SIZE, remaining))
+            assert chunk, "Connection closed before end of body"
+            remaining -= len(chunk)
+            yield chunk
+    else:
+        while True:
+            chunk = response.read1(READ_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+
+# undoes gzip/deflate content encoding chunk by chunk
+def decompress(chunks, encoding):
+    if encoding == "gzip":
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    else:
+        decompressor = zlib.decompressobj()
+    first = True
+    for chunk in chunks:
+        try:
+            data = decompressor.decompress(chunk)
+        except zlib.error:
+            # some servers send raw deflate without the zlib wrapper
+            if not (first and encoding == "deflate"):
+                raise
+            decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            data = decompressor.decompress(chunk)
+        first = False
+        if data:
+            yield data
+    data = decompressor.flush()
+    if data:
+        yield data
+
+
+# charset parameter of Content-Type, utf8 if missing or unknown
+def get_charset(headers):
+    for param in headers.get("content-type", "").split(";")[1:]:
+        if "=" in param:
+            name, value = param.split("=", 1)
+            if name.strip().lower() == "charset":
+                charset = value.strip().strip("\"'")
+                try:
+                    codecs.lookup(charset)
+                    return charset
+                except LookupError:
+                    break
+    return "utf8"
+
+
+# yields the body as text: de-chunked, decompressed and decoded
+# incrementally so multi-byte characters may straddle chunks
+def read_body(response, headers):
+    chunks = read_raw_body(response, headers)
+    encoding = headers.get("content-encoding", "identity").lower()
+    if encoding in ["gzip", "x-gzip", "deflate"]:
+        chunks = decompress(chunks, "deflate" if encoding == "deflate"
+                            else "gzip")
+    else:
+        assert encoding == "identity", \
+            "Unknown content encoding {}".format(encoding)
+    decoder = codecs.getincrementaldecoder(get_charset(headers))(
+        errors="replace")
+    for chunk in chunks:
+        text = decoder.decode(chunk)
+        if text:
+            yield text
+    text = decoder.decode(b"", final=True)
+    if text:
+        yield text
@@ -25,7 +25,10 @@ Event.prototype.preventDefault = function() {
 Node.prototype.addEventListener = function(type, listener) {
     if (!LISTENERS[this.handle]) LISTENERS[this.handle] = {};
     var dict = LISTENERS[this.handle];
-    if (!dict[type]) dict[type] = [];
+    if (!dict[type]) {
+        dict[type] = [];
+        call_python("addEventListener", this.handle, type);
+    }
     var list = dict[type];
     list.push(listener);
 }
@@ -46,6 +49,10 @@ Node.prototype.dispatchEvent = function(evt) {
     return evt.do_default;
 }
 
+function __dispatchEvent(handle, type) {
+    return new Node(handle).dispatchEvent(new Event(type));
+}
+
 function XMLHttpRequest() {}
 
 XMLHttpRequest.prototype.open = function(method, url, is_async) {
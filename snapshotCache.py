@@ -0,0 +1,155 @@
+import gc
+import hashlib
+import marshal
+import os
+from array import array
+from htmlParser import HTMLParser, NodeStore
+from cssParser import CSSParser, TagSelector, ClassSelector, \
+    DescendantSelector
+
+SNAPSHOT_DIR = os.path.join(os.path.expanduser("~"), ".cache", "browser",
+                            "snapshots")
+# total size of snapshot files before the least recently used are removed
+SNAPSHOT_CACHE_SIZE = 200 * 1024 * 1024
+# bumped whenever the parser or the snapshot layout changes, so old
+# snapshots are never loaded
+SNAPSHOT_VERSION = 1
+
+
+# parsed documents and style sheets saved on disk, keyed by a hash of
+# their source, so source seen before is loaded instead of parsed
+# documents are NodeStore columns and rule lists are nested tuples,
+# both written with marshal
+class SnapshotCache:
+    def __init__(self, directory=SNAPSHOT_DIR, max_size=SNAPSHOT_CACHE_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    # the root of the DOM tree for html source
+    def document(self, body):
+        path = self.path(body, "html")
+        # like the parser, don't let garbage collection passes run over
+        # the tree while it is built
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            columns = self.read(path)
+            if columns is not None:
+                store = NodeStore()
+                store.tags, parents, store.data = columns
+                store.parents = array("i")
+                store.parents.frombytes(parents)
+                return store.to_tree()
+        finally:
+            if gc_enabled:
+                gc.enable()
+        root = HTMLParser(body).parse()
+        store = NodeStore.from_tree(root)
+        self.write(path, (store.tags, store.parents.tobytes(), store.data))
+        return root
+
+    # the rule list of a style sheet, as CSSParser.parse returns it
+    def rules(self, source):
+        path = self.path(source, "css")
+        rules = self.read(path)
+        if rules is not None:
+            return [(decode_selector(selector), body)
+                    for selector, body in rules]
+        rules = CSSParser(source).parse()
+        self.write(path, [(encode_selector(selector), body)
+                          for selector, body in rules])
+        return rules
+
+    def path(self, source, kind):
+        digest = hashlib.sha1(source.encode("utf8")).hexdigest()
+        return os.path.join(self.directory, digest + "." + kind)
+
+    def read(self, path):
+        try:
+            with open(path, "rb") as f:
+                version, value = marshal.loads(f.read())
+        except (OSError, EOFError, ValueError, TypeError):
+            self.misses += 1
+            return None
+        if version != SNAPSHOT_VERSION:
+            self.misses += 1
+            return None
+        self.hits += 1
+        # keep least recently used order by modification time
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return value
+
+    def write(self, path, value):
+        tmp = path + ".tmp"
+        try:
+            with open(tmp, "wb") as f:
+                marshal.dump((SNAPSHOT_VERSION, value), f)
+            os.replace(tmp, path)
+        except OSError:
+            return
+        self.evict()
+
+    # remove least recently used snapshots past max_size
+    def evict(self):
+        files = []
+        total = 0
+        for name in os.listdir(self.directory):
+            try:
+                info = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            files.append((info.st_mtime, info.st_size, name))
+            total += info.st_size
+        files.sort()
+        while total > self.max_size and len(files) > 1:
+            _, size, name = files.pop(0)
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+# selectors as nested tuples marshal can write
+def encode_selector(selector):
+    if isinstance(selector, DescendantSelector):
+        return ("descendant", encode_selector(selector.ancestor),
+                encode_selector(selector.descendant))
+    if isinstance(selector, ClassSelector):
+        return ("class", selector.cls)
+    return ("tag", selector.tag)
+
+
+def decode_selector(encoded):
+    if encoded[0] == "descendant":
+        return DescendantSelector(decode_selector(encoded[1]),
+                                  decode_selector(encoded[2]))
+    if encoded[0] == "class":
+        return ClassSelector(encoded[1])
+    return TagSelector(encoded[1])
+
+
+# only used when BROWSER_SNAPSHOTS is set: looking a page up needs all
+# of it, so it can't be painted while it is still loading
+SNAPSHOTS = SnapshotCache() if os.environ.get("BROWSER_SNAPSHOTS") else None
@@ -1,25 +1,59 @@
 
 
+import time
 import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 import dukpy
 from htmlParser import Element, Text, HTMLParser
-from cssParser import cascade_priority, resolve_url, style, tree_to_list, CSSParser
-from layoutEngine import DocumentLayout
-from network import request, url_origin
+from cssParser import resolve_url, style, tree_to_list, parse_stylesheet, StyleSheet
+from layoutEngine import DocumentLayout, InputLayout
+from displayList import DisplayList, PageDrawing
+from layoutIndex import LayoutIndex
+from network import request, stream, url_origin
 from jsContext import JSContext
-from display import HEIGHT, SCROLL_STEP, CHROME_PX
+from backForwardCache import BackForwardCache
+import snapshotCache
+from display import HEIGHT, SCROLL_STEP, CHROME_PX, LAYOUT_OVERSCAN
+
+# scripts and stylesheets are fetched on a shared, bounded pool
+MAX_FETCH_WORKERS = 6
+FETCH_POOL = ThreadPoolExecutor(max_workers=MAX_FETCH_WORKERS)
+# while a page streams in, try a first paint once this many characters
+# are in, then each time the input has doubled (so a page that never
+# fills the viewport costs at most about two extra renders of itself)
+FIRST_PAINT_CHARS = 16384
 
 
 class Tab:
-    def __init__(self):
+    # on_paint is called to put a partially loaded page on screen
+    def __init__(self, on_paint=None):
         self.history = []
+        # where the page shown is in the history
+        self.history_index = None
+        self.posted = False
+        # pages recently left, to go back to without loading them
+        self.back_forward = BackForwardCache()
         self.focus = None
         self.url = None
+        self.scroll = 0
+        self.on_paint = on_paint
+        self.document = None
+        # built from the layout tree when first needed after it changed
+        self.layout_index = None
+        self.drawing = PageDrawing()
+        # roots of subtrees changed since the last render
+        self.dirty_nodes = []
+        self.renders = 0
+        # only lay out the page down to just below the viewport,
+        # and more of it as it is scrolled
+        self.lazy_layout = True
 
         # parser goes through file and returns a list of styles as
         # [(selectorObject1, {p1: v1, p2: v2}), (selector2, {....})]
+        # (shared with every other tab through the style sheet cache)
         with open("browser8.css") as f:
-            self.default_style_sheet = CSSParser(f.read()).parse()
+            self.default_style_sheet = parse_stylesheet(
+                f.read(), "file://browser8.css")
 
     def allowed_request(self, url):
         return self.allowed_origins == None or \
@@ -30,19 +64,39 @@ class Tab:
     # create html tree from body & store all scripts & styles needed
     # then finally render the page
     def load(self, url, body=None):
-        headers, body = request(url, self.url, payload=body)
-        self.scroll = 0
-        self.url = url
-        self.history.append(url)
+        # keep the page being left for going back to, unless it was a
+        # form submission (or going back has already dropped it from
+        # the history)
+        if self.document and not self.posted \
+                and self.history_index < len(self.history):
+            self.back_forward.store(self.history_index, self)
+        self.posted = body is not None
+        self.timings = []
+        start = time.time()
+        headers, body = stream(url, self.url, payload=body)
+        # closed even if something fails before it is read
+        try:
+            self.scroll = 0
+            self.focus = None
+            self.url = url
+            self.history.append(url)
+            self.history_index = len(self.history) - 1
 
-        self.allowed_origins = None
-        if "content-security-policy" in headers:
-            csp = headers["content-security-policy"].split()
-            if len(csp) > 0 and csp[0] == "default-src":
-                self.allowed_origins = csp[1:]
+            self.allowed_origins = None
+            if "content-security-policy" in headers:
+                csp = headers["content-security-policy"].split()
+                if len(csp) > 0 and csp[0] == "default-src":
+                    self.allowed_origins = csp[1:]
 
-        # create tree from html file's contents & returns root
-        self.nodes = HTMLParser(body).parse()
+            # create tree from html file's contents & returns root
+            if snapshotCache.SNAPSHOTS:
+                # (looked up by the whole body, so nothing is painted early)
+                self.nodes = snapshotCache.SNAPSHOTS.document("".join(body))
+            else:
+                self.nodes = self.parse(body)
+        finally:
+            body.close()
+        self.timings.append(("document", url, 0, time.time() - start))
 
         self.js = JSContext(self)
         # store src for node where tag is script
@@ -52,57 +106,187 @@ class Tab:
                    if isinstance(node, Element)
                    and node.tag == "script"
                    and "src" in node.attributes]
+        # start fetching every allowed script and stylesheet at once;
+        # they are still used one by one in document order below
+        self.pending_fetches = {}
+        for src in scripts + self.stylesheet_links():
+            self.prefetch(resolve_url(src, url))
         # resolve and execute each script
         for script in scripts:
             script_url = resolve_url(script, url)
             if not self.allowed_request(script_url):
                 print("Blocked script", script, "due to CSP")
                 continue
-            header, body = request(script_url, url)
+            header, body = self.fetch(script_url, "script")
             try:
                 print("Script returned: ", self.js.run(body))
             except dukpy.JSRuntimeError as e:
                 print("Script", script, "crashed", e)
 
-        self.rules = self.default_style_sheet.copy()
+        self.rules = list(self.default_style_sheet)
 
-        # store href of each element with tag link & rel stylesheet
-        links = [node.attributes["href"]
-                 for node in tree_to_list(self.nodes, [])
-                 if isinstance(node, Element)
-                 and node.tag == "link"
-                 and "href" in node.attributes
-                 and node.attributes.get("rel") == "stylesheet"]
-
-        for link in links:
+        # collected again since scripts may have changed the page
+        for link in self.stylesheet_links():
             # resolve each href, then call cssParser
             style_url = resolve_url(link, url)
             if not self.allowed_request(style_url):
                 print("Blocked style", link, "due to CSP")
                 continue
             try:
-                header, body = request(style_url, url)
+                header, body = self.fetch(style_url, "stylesheet")
             except:
                 continue
             # rules contains all parsed rules of form
             # [(selectorObj1, {}), (selectorObj2, {}), ...]
-            self.rules.extend(CSSParser(body).parse())
+            self.rules.extend(parse_stylesheet(body, style_url))
+        self.stylesheet = StyleSheet(self.rules)
 
+        self.pending_fetches = {}
+        # a full render: changes made by scripts are covered by it
+        self.clear_dirty()
         self.render()
 
+    # feed body chunks to the parser as they arrive from the network
+    # and paint the first viewport as soon as there is enough to fill it
+    def parse(self, chunks):
+        parser = HTMLParser()
+        painted = self.on_paint is None
+        received = 0
+        next_paint = FIRST_PAINT_CHARS
+        for chunk in chunks:
+            parser.feed(chunk)
+            received += len(chunk)
+            if not painted and received >= next_paint:
+                painted = self.paint_partial(parser)
+                next_paint = received * 2
+        return parser.close()
+
+    # render whatever has been parsed so far with the default style sheet
+    # returns True once that fills the viewport
+    def paint_partial(self, parser):
+        if not parser.unfinished:
+            return False
+        self.nodes = parser.unfinished[0]
+        self.rules = list(self.default_style_sheet)
+        self.stylesheet = StyleSheet(self.rules)
+        self.render()
+        if self.document.height < HEIGHT - CHROME_PX:
+            return False
+        self.on_paint()
+        return True
+
+    # store href of each element with tag link & rel stylesheet
+    def stylesheet_links(self):
+        return [node.attributes["href"]
+                for node in tree_to_list(self.nodes, [])
+                if isinstance(node, Element)
+                and node.tag == "link"
+                and "href" in node.attributes
+                and node.attributes.get("rel") == "stylesheet"]
+
+    # queue a subresource on the fetch pool; the future resolves to
+    # (headers, body, seconds waiting for a worker, seconds fetching)
+    def prefetch(self, url):
+        if url in self.pending_fetches or not self.allowed_request(url):
+            return
+        queued = time.time()
+        top_level_url = self.url
+
+        def fetch():
+            start = time.time()
+            headers, body = request(url, top_level_url)
+            return headers, body, start - queued, time.time() - start
+        self.pending_fetches[url] = FETCH_POOL.submit(fetch)
+
+    # wait for a prefetched subresource, fetching it now if nothing
+    # was queued for it, and record how long it took
+    def fetch(self, url, kind):
+        self.prefetch(url)
+        headers, body, waited, took = self.pending_fetches[url].result()
+        self.timings.append((kind, url, waited, took))
+        return headers, body
+
+    # mark node's subtree as changed; the next render only restyles
+    # and lays out the dirty subtrees
+    def invalidate(self, node, style=True, layout=True):
+        node.style_dirty = node.style_dirty or style
+        node.layout_dirty = node.layout_dirty or layout
+        self.dirty_nodes.append(node)
+
+    # render now if the page changed since the last render; anything
+    # reading the layout calls this first
+    def flush_render(self):
+        if self.dirty_nodes:
+            self.render()
+
     def render(self):
+        self.renders += 1
+        if self.document and self.document.node is self.nodes \
+                and self.dirty_nodes:
+            self.render_dirty()
+            return
+        self.clear_dirty()
         # add style dictionary to each node and its children with
         # appropriate values for each {prop, val}
         # node.style = {p1: v1, p2: v2...}
-        style(self.nodes, sorted(self.rules, key=cascade_priority))
+        style(self.nodes, self.stylesheet)
 
         # from root to end of tree
         # makes each node block or input object
         # decides their size and position
         # then lays them onto the canvas with paint method
         self.document = DocumentLayout(self.nodes)
-        self.document.layout()
-        self.display_list = []
+        self.document.layout(self.layout_limit(self.scroll))
+        self.paint()
+
+    # how far down to lay out the page when scrolled to scroll
+    # (None: all of it)
+    def layout_limit(self, scroll):
+        if not self.lazy_layout:
+            return None
+        return scroll + HEIGHT - CHROME_PX + LAYOUT_OVERSCAN
+
+    # lay out and paint more of the page before scrolling to scroll
+    def extend_layout(self, scroll):
+        if not self.lazy_layout:
+            return
+        for obj in self.document.extend(self.layout_limit(scroll)):
+            obj.paint(self.display_list)
+            self.layout_index = None
+
+    # restyle and relayout only the subtrees marked by invalidate
+    def render_dirty(self):
+        roots = []
+        for node in self.dirty_nodes:
+            # skip nodes under another dirty node or no longer in the page
+            ancestor = node.parent
+            attached = node is self.nodes
+            while ancestor:
+                if ancestor.style_dirty or ancestor.layout_dirty:
+                    break
+                attached = ancestor is self.nodes
+                ancestor = ancestor.parent
+            else:
+                if attached and node not in roots:
+                    roots.append(node)
+        for node in roots:
+            if node.style_dirty:
+                style(node, self.stylesheet)
+        for node in roots:
+            if node.layout_dirty:
+                self.document.relayout(node)
+        self.clear_dirty()
+        self.paint()
+
+    def clear_dirty(self):
+        for node in self.dirty_nodes:
+            node.style_dirty = False
+            node.layout_dirty = False
+        self.dirty_nodes = []
+
+    def paint(self):
+        self.display_list = DisplayList()
+        self.layout_index = None
 
         # calls inline or block object's paint method
         # From root node to end node
@@ -113,47 +297,55 @@ class Tab:
         # WHAT IS DISPLAY_LIST?
         self.document.paint(self.display_list)
 
+    def get_layout_index(self):
+        self.flush_render()
+        if self.layout_index is None:
+            self.layout_index = LayoutIndex(self.document)
+        return self.layout_index
+
     # called by browser to draw contents
+    # the page's canvas items are kept from frame to frame (see
+    # PageDrawing); the caret is drawn again every time
     def draw(self, canvas):
-        for cmd in self.display_list:
-            if cmd.top > self.scroll + HEIGHT - CHROME_PX:
-                continue
-            if cmd.bottom < self.scroll:
-                continue
-            cmd.execute(self.scroll - CHROME_PX, canvas)
+        self.flush_render()
+        self.drawing.draw(canvas, self.display_list, self.scroll)
 
+        canvas.delete("caret")
         if self.focus:
-            obj = [obj for obj in tree_to_list(self.document, [])
-                   if obj.node == self.focus][0]
+            obj = self.get_layout_index().layout_for(self.focus)
             text = self.focus.attributes.get("value", "")
             x = obj.x + obj.font.measure(text)
             y = obj.y - self.scroll + CHROME_PX
-            canvas.create_line(x, y, x, y + obj.height)
+            canvas.create_line(x, y, x, y + obj.height, tags="caret")
 
-    def scrolldown(self):
+    # the canvas was cleared or is showing another tab
+    def forget_drawing(self):
+        self.drawing.forget()
+
+    # scroll by dy pixels, staying within the page
+    def scroll_by(self, dy):
+        self.flush_render()
+        scroll = self.scroll + dy
+        self.extend_layout(scroll)
         max_y = self.document.height - (HEIGHT - CHROME_PX)
-        self.scroll = min(self.scroll + SCROLL_STEP, max_y)
+        self.scroll = max(0, min(scroll, max_y))
+
+    def scrolldown(self):
+        self.scroll_by(SCROLL_STEP)
 
     def scrollup(self):
-        if self.scroll <= 0:
-            return
-        self.scroll -= SCROLL_STEP
+        self.scroll_by(-SCROLL_STEP)
 
     def on_mousewheel(self, e):
-        max_y = self.document.height - (HEIGHT - CHROME_PX)
-        if (self.scroll <= 0 and e.delta > 0) or (self.scroll >= max_y and e.delta < 0):
-            return
-        self.scroll += -5*(e.delta)
+        self.scroll_by(-5*(e.delta))
 
     def click(self, x, y):
         self.focus = None
         y += self.scroll
-        objs = [obj for obj in tree_to_list(self.document, [])
-                if obj.x <= x < obj.x + obj.width
-                and obj.y <= y < obj.y + obj.height]
-        if not objs:
+        obj = self.get_layout_index().hit(x, y)
+        if not obj:
             return
-        elt = objs[-1].node
+        elt = obj.node
         if elt and self.js.dispatch_event("click", elt):
             return
         while elt:
@@ -198,10 +390,38 @@ class Tab:
             if self.js.dispatch_event("keydown", self.focus):
                 return
             self.focus.attributes["value"] += char
-        self.document.paint(self.display_list)  # TODO: is this necessary?
+            self.repaint_input(self.focus)
+
+    # the value of an input changed: replace just its draw commands,
+    # unless its box changed and the line has to be laid out again
+    def repaint_input(self, node):
+        obj = self.get_layout_index().layout_for(node)
+        if not isinstance(obj, InputLayout):
+            return
+        geometry = (obj.x, obj.width, obj.height)
+        obj.layout()
+        commands = obj.draw_commands()
+        if (obj.x, obj.width, obj.height) != geometry \
+                or len(commands) != len(obj.commands):
+            self.invalidate(node, style=False)
+            self.render()
+            return
+        for i, cmd in enumerate(commands):
+            self.display_list.replace(obj.painted_at + i, cmd)
+        obj.commands = commands
 
     def go_back(self):
         if len(self.history) > 1:
             self.history.pop()
             back = self.history.pop()
+            index = len(self.history)
+            # pages after back can't be gone to again
+            self.back_forward.discard_from(index + 1)
+            page = self.back_forward.take(index, back)
+            if page:
+                self.history.append(back)
+                self.clear_dirty()
+                page.restore(self)
+                self.posted = False
+                return
             self.load(back)